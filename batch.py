@@ -0,0 +1,138 @@
+"""batch.py - Compiling many set lists at once from a manifest
+
+A manifest is a JSON file listing set lists, each with its songs, the
+outputs to make and how to transpose its chords:
+
+{"setlists": [
+  {"name": "sunday 9am",
+   "songs": ["AmazingGrace.txt", "SolidRock.txt"],
+   "chords": "sunday-9am-chords.pdf",
+   "slides": "sunday-9am-slides.pdf",
+   "transpose": -2, "flats": true}
+]}
+
+Songs are files in the song directory, outputs are relative to the
+manifest, and each set list needs a chords and/or slides output. Every
+song file in the batch is parsed once, however many set lists share it,
+and the pdflatex jobs of all set lists run in a bounded pool of threads.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import json
+import os
+import subprocess
+import time
+
+import core
+import transpose
+
+
+class ManifestError(Exception):
+    """Raised when a manifest cannot be read or is not valid"""
+
+
+def load_manifest(filename):
+    """Returns the list of set lists in a manifest file
+
+    Each set list is a dict with its name, songs, outputs (mode -> output
+    filename), transpose and flats. Raises ManifestError if it is invalid.
+    """
+    try:
+        with open(filename, "r") as f:
+            manifest = json.load(f)
+    except (IOError, OSError, ValueError) as err:
+        raise ManifestError("Cannot read manifest {}: {}".format(filename, err))
+    if not isinstance(manifest, dict) or not isinstance(manifest.get("setlists"), list):
+        raise ManifestError("Manifest {} has no list of setlists".format(filename))
+
+    directory = os.path.dirname(os.path.abspath(filename))
+    setlists = []
+    for number, entry in enumerate(manifest["setlists"], 1):
+        if not isinstance(entry, dict):
+            raise ManifestError("Set list {} is not a JSON object".format(number))
+        name = entry.get("name", "set list {}".format(number))
+        songs = entry.get("songs")
+        if not isinstance(songs, list) or len(songs) == 0 \
+           or not all(isinstance(song, str) for song in songs):
+            raise ManifestError("{}: no list of song files".format(name))
+        outputs = dict((mode, os.path.join(directory, entry[mode]))
+                       for mode in core.templates if entry.get(mode))
+        if len(outputs) == 0:
+            raise ManifestError("{}: no chords or slides output".format(name))
+        halfsteps = entry.get("transpose")
+        if halfsteps is not None and not isinstance(halfsteps, int):
+            raise ManifestError("{}: transpose must be a number of half steps".format(name))
+        setlists.append({"name": name, "songs": songs, "outputs": outputs,
+                         "transpose": halfsteps, "flats": bool(entry.get("flats"))})
+    return setlists
+
+
+def run_batch(setlists, songdir="songs", cache=None, formats=None, workers=None,
+              pdfcache=None, pipe=False, jobs=2, report=None, templatedirs=()):
+    """Compile every output of the set lists, returning a list of results
+
+    Each result is (set list name, mode, output, error, seconds), where
+    error is the error of pdflatex, or the message of a song that cannot be
+    compiled or an output that cannot be written. The song files are
+    parsed first, each once, in a process pool of workers. Then the songs
+    of every output are compiled, and at most jobs pdflatex runs happen at
+    once. report, if given, is called with each result as it is ready.
+    templatedirs are searched for templates before the user's template
+    directories.
+    """
+    def new_praisetex():
+        praisetex = core.PraiseTex(songdir, cache=cache, workers=workers,
+                                   formats=formats, pdfcache=pdfcache)
+        praisetex.pipe = pipe
+        praisetex.templateDirs = list(templatedirs) + praisetex.templateDirs
+        if jobs > 1:
+            praisetex.stdout = subprocess.DEVNULL # keep jobs from interleaving
+        return praisetex
+
+    # parse each song file of the whole batch once, shared by every set list
+    shared = new_praisetex()
+    shared.parseSongs([os.path.join(songdir, song)
+                       for setlist in setlists for song in setlist["songs"]])
+
+    results = []
+    def finish(result):
+        results.append(result)
+        if report is not None:
+            report(*result)
+
+    builds = [] # (set list name, mode, output, PraiseTex, song texts)
+    for setlist in setlists:
+        praisetex = new_praisetex()
+        praisetex.parsed = shared.parsed
+        if setlist["transpose"] is not None:
+            praisetex.transposer = transpose.Transposer(setlist["transpose"],
+                                                        not setlist["flats"])
+        for index, song in enumerate(setlist["songs"]):
+            praisetex.addSong(index, song)
+        for mode, output in sorted(setlist["outputs"].items()):
+            try:
+                songtexts = list(praisetex.songTexts(mode))
+            except core.CompileError as err: # only this output fails
+                finish((setlist["name"], mode, output, str(err), 0.0))
+                continue
+            builds.append((setlist["name"], mode, output, praisetex, songtexts))
+
+    def build(praisetex, mode, output, songtexts):
+        start = time.time()
+        try:
+            if mode == "chords":
+                error = praisetex.compileChords(output, songtexts)
+            else:
+                error = praisetex.compileSlides(output, songtexts)
+        except Exception as err: # only this output fails, such as a missing directory
+            error = "Cannot create {}: {}".format(output, err)
+        return error, time.time() - start
+
+    with ThreadPoolExecutor(max(1, jobs)) as pool:
+        futures = dict((pool.submit(build, praisetex, mode, output, songtexts),
+                        (name, mode, output))
+                       for name, mode, output, praisetex, songtexts in builds)
+        for future in as_completed(futures):
+            error, seconds = future.result()
+            finish(futures[future] + (error, seconds))
+    return results
@@ -0,0 +1,6 @@
+"""Benchmarks of the praisetex parser and builds over synthetic songs
+
+Run from the praisetex directory with
+
+>  python -m benchmarks
+"""
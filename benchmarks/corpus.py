@@ -0,0 +1,150 @@
+"""corpus.py - Synthetic song files for benchmarking praisetex
+
+Songs are generated from a seed, so the same corpus can be benchmarked
+again after the parser changes. Run as a script to write a corpus:
+
+>  python -m benchmarks.corpus DIRECTORY COUNT
+"""
+
+import argparse
+import os
+import random
+
+import song
+
+roots = ["A", "Bb", "B", "C", "C#", "D", "Eb", "E", "F", "F#", "G", "Ab"]
+qualities = ["", "", "", "m", "m", "7", "m7", "maj7", "sus4", "sus2", "add9", "2"]
+bass_notes = ["A", "B", "C", "C#", "D", "E", "F", "F#", "G", "Bb"]
+
+# words lyrics are made of, none of which could be mistaken for chords
+words = [word for word in """amazing grace how sweet the sound that saved
+    wretch like me once was lost but now am found blind see holy lord god
+    almighty early morning our voice shall rise to thee merciful mighty
+    three persons blessed trinity be thou my vision heart naught else
+    best thought by day or night waking sleeping presence light hope
+    built on nothing less than jesus blood righteousness dare not trust
+    sweetest frame wholly lean name solid rock stand other ground sinking
+    sand""".split() if not song.is_chord_line(word)]
+
+# commands that start stanzas, with how many of each a song may have
+stanza_kinds = [("verse", 4), ("chorus", 2), ("prechorus", 1), ("bridge", 2),
+                ("tag", 1), ("intro", 1), ("outro", 1), ("interlude", 1),
+                ("break", 1)]
+
+
+def chord(rng, slash_chords):
+    """Returns a random chord, a slash chord with probability slash_chords"""
+    name = rng.choice(roots) + rng.choice(qualities)
+    if rng.random() < slash_chords:
+        name += "/" + rng.choice(bass_notes)
+    return name
+
+def lyric_line(rng):
+    """Returns a random line of lyrics"""
+    line = " ".join(rng.choice(words) for i in range(rng.randint(3, 9)))
+    if rng.random() < 0.05:
+        line += " (" + rng.choice(words) + ")" # echo
+    if rng.random() < 0.03:
+        line = line.replace(" ", " & ", 1)
+    return line[0].upper() + line[1:]
+
+def chord_line(rng, lyrics, slash_chords):
+    """Returns a line of chords spread over the lyrics below it"""
+    line = ""
+    width = max(len(lyrics), 8)
+    for i in range(rng.randint(1, 5)):
+        start = len(line) + 1 if line else 0
+        if start >= width:
+            break
+        line = line.ljust(rng.randint(start, width)) + chord(rng, slash_chords)
+    return line
+
+def stanza_names(rng, count):
+    """Returns the names of count stanzas, such as verse 2 or chorus"""
+    names = []
+    while len(names) < count:
+        kind, most = rng.choice(stanza_kinds)
+        numbered = [name for name in names if name.split()[0] == kind]
+        if len(numbered) >= most:
+            continue
+        if most > 1:
+            names.append("{} {}".format(kind, len(numbered) + 1))
+        elif kind not in names:
+            names.append(kind)
+    return names
+
+def order_entries(rng, names):
+    """Returns the entries of an order line, some of them repeated
+
+    Repeats are written both ways expand_order accepts, such as x2 and 3x.
+    """
+    entries = []
+    for i in range(rng.randint(len(names), 2 * len(names))):
+        name = rng.choice(names)
+        repeat = rng.random()
+        if repeat < 0.1:
+            name += " x2"
+        elif repeat < 0.15:
+            name += " x3"
+        elif repeat < 0.2:
+            name += " 3x"
+        entries.append(name)
+    return entries
+
+def generate_song(rng, stanzas=(2, 8), lines=(2, 8), chord_density=0.7,
+                  slash_chords=0.15, order=0.6):
+    """Returns the text of a random song file
+
+    stanzas and lines are the (least, most) stanzas per song and lyric lines
+    per stanza, chord_density is the share of lyric lines with chords above
+    them, slash_chords the share of chords with a bass note, and order the
+    share of songs with an order line.
+    """
+    text = ["title: " + lyric_line(rng)[:30].strip(),
+            "by: " + lyric_line(rng)[:25].strip()]
+    if rng.random() < 0.3:
+        text.append("capo: {}".format(rng.randint(1, 5)))
+    if rng.random() < 0.2:
+        text.append("comment: " + lyric_line(rng))
+    names = stanza_names(rng, rng.randint(*stanzas))
+    if rng.random() < order:
+        text.append("order: " + ", ".join(order_entries(rng, names)))
+
+    for name in names:
+        text.append("")
+        text.append(name + ":")
+        for i in range(rng.randint(*lines)):
+            lyrics = lyric_line(rng)
+            if rng.random() < chord_density:
+                text.append(chord_line(rng, lyrics, slash_chords))
+            text.append(lyrics)
+    return "\n".join(text) + "\n"
+
+def write_corpus(directory, count, seed=0, **options):
+    """Write count song files into directory, returning their filenames
+
+    options are passed on to generate_song.
+    """
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    rng = random.Random(seed)
+    filenames = []
+    for number in range(count):
+        filename = "song{:05d}.txt".format(number)
+        with open(os.path.join(directory, filename), "w") as f:
+            f.write(generate_song(rng, **options))
+        filenames.append(filename)
+    return filenames
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Write synthetic song files for benchmarking.')
+    parser.add_argument('directory')
+    parser.add_argument('count', type=int)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--chord-density', type=float, default=0.7)
+    parser.add_argument('--slash-chords', type=float, default=0.15)
+    args = parser.parse_args()
+    write_corpus(args.directory, args.count, args.seed,
+                 chord_density=args.chord_density,
+                 slash_chords=args.slash_chords)
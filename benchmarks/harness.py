@@ -0,0 +1,202 @@
+"""harness.py - Timing the parser and builds over synthetic song corpora
+
+Times parse_structure, every pass of the front end, chords and slides
+pipelines, compile_chords, compile_slides and whole builds for corpora of
+increasing size, and writes the results as JSON so runs can be compared:
+
+>  python -m benchmarks --sizes 10 100 1000 --output before.json
+>  python -m benchmarks --sizes 10 100 1000 --compare before.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+import cache
+import core
+import parse
+from benchmarks import corpus
+
+# version of the results format
+version = 1
+
+
+def best_time(function, repeat):
+    """Returns the shortest of repeat timings of function, in seconds"""
+    best = None
+    for i in range(repeat):
+        start = time.perf_counter()
+        function()
+        seconds = time.perf_counter() - start
+        if best is None or seconds < best:
+            best = seconds
+    return best
+
+def pass_name(pipeline, function):
+    """Returns the name a pass is reported under"""
+    return "{}.{}".format(pipeline, function.__name__)
+
+def time_passes(name, pipeline, songs, repeat):
+    """Time each pass of a pipeline on its own over all songs
+
+    songs are the inputs of the pipeline, and each pass gets the outputs of
+    the one before it. Returns a list of (benchmark name, seconds) and the
+    outputs of the last pass.
+    """
+    timings = []
+    for function in pipeline.passes:
+        single = parse.Pipeline(function)
+        inputs = songs
+        def run():
+            return [single.run(song) for song in inputs]
+        timings.append((pass_name(name, function), best_time(run, repeat)))
+        songs = run()
+    return timings, songs
+
+def time_parser(directory, filenames, repeat):
+    """Returns a list of (benchmark name, seconds) for the parser alone"""
+    paths = [os.path.join(directory, filename) for filename in filenames]
+    texts = []
+    for path in paths:
+        with open(path, "r") as f:
+            texts.append(f.read())
+    lines = [text.split('\n') for text in texts]
+
+    timings = [("parse_structure",
+                best_time(lambda: [parse.parse_structure(l) for l in lines], repeat))]
+    structures = [parse.parse_structure(l) for l in lines]
+    passes, stanzas = time_passes("front_end", parse.front_end_pipeline,
+                                  structures, repeat)
+    timings.extend(passes)
+
+    songs = [parse.parse_song(path, text) for path, text in zip(paths, texts)]
+    for mode, pipeline in (("chords", parse.chords_pipeline),
+                           ("slides", parse.slides_pipeline)):
+        passes, rendered = time_passes(mode, pipeline,
+                                       [song.stanza_lists() for song in songs], repeat)
+        timings.extend(passes)
+
+    timings.append(("compile_chords",
+                    best_time(lambda: [parse.compile_chords(p) for p in paths], repeat)))
+    timings.append(("compile_slides",
+                    best_time(lambda: [parse.compile_slides(p) for p in paths], repeat)))
+    return timings
+
+def time_builds(directory, filenames, repeat, latex):
+    """Returns a list of (benchmark name, seconds) for whole builds
+
+    A build compiles every song and writes the document for both modes. The
+    cold build starts from nothing, the warm one from a filled fragment
+    cache and parsed songs. pdflatex is only run if latex is True.
+    """
+    cachedir = tempfile.mkdtemp(prefix="praisetex-bench")
+    outdir = tempfile.mkdtemp(prefix="praisetex-bench")
+    try:
+        def praisetex():
+            praisetex = core.PraiseTex(directory, cache=cache.FragmentCache(cachedir))
+            for index, filename in enumerate(filenames):
+                praisetex.addSong(index, filename)
+            return praisetex
+
+        def documents(praisetex):
+            for mode in ("chords", "slides"):
+                with open(os.path.join(outdir, mode + ".tex"), "w") as f:
+                    f.writelines(praisetex.songTexts(mode))
+
+        def cold():
+            shutil.rmtree(cachedir)
+            documents(praisetex())
+
+        warm = praisetex()
+        documents(warm)
+        timings = [("build_cold", best_time(cold, repeat)),
+                   ("build_warm", best_time(lambda: documents(warm), repeat))]
+
+        if latex:
+            def pdf():
+                warm.compileOutputs({"chords": os.path.join(outdir, "chords.pdf"),
+                                     "slides": os.path.join(outdir, "slides.pdf")})
+            timings.append(("build_pdflatex", best_time(pdf, 1)))
+        return timings
+    finally:
+        shutil.rmtree(cachedir, ignore_errors=True)
+        shutil.rmtree(outdir, ignore_errors=True)
+
+def run(sizes, repeat=3, seed=0, latex=False, report=None):
+    """Run every benchmark for each corpus size, returning the results
+
+    report, if given, is called with each result as it is measured.
+    """
+    results = []
+    for size in sizes:
+        directory = tempfile.mkdtemp(prefix="praisetex-corpus")
+        try:
+            filenames = corpus.write_corpus(directory, size, seed)
+            timings = time_parser(directory, filenames, repeat)
+            timings.extend(time_builds(directory, filenames, repeat, latex))
+        finally:
+            shutil.rmtree(directory)
+        for name, seconds in timings:
+            result = {"benchmark": name, "songs": size, "seconds": seconds}
+            results.append(result)
+            if report is not None:
+                report(result)
+    return {"version": version,
+            "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": os.cpu_count(),
+            "parser": cache.parser_version(),
+            "repeat": repeat,
+            "seed": seed,
+            "results": results}
+
+def compare(before, after):
+    """Yield (benchmark, songs, seconds before, seconds after) for the
+    benchmarks both runs have"""
+    old = dict(((result["benchmark"], result["songs"]), result["seconds"])
+               for result in before["results"])
+    for result in after["results"]:
+        key = (result["benchmark"], result["songs"])
+        if key in old:
+            yield key + (old[key], result["seconds"])
+
+def print_result(result):
+    print("{:>6} songs  {:<45} {:10.4f}s".format(result["songs"], result["benchmark"],
+                                                 result["seconds"]), file=sys.stderr)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the praisetex parser and builds.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000, 10000],
+                        metavar='N', help='numbers of songs to benchmark (default: 10 100 1000 10000)')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='timings to take the best of (default: 3)')
+    parser.add_argument('--seed', type=int, default=0,
+                        help='seed of the synthetic corpus (default: 0)')
+    parser.add_argument('--latex', action='store_true', default=False,
+                        help='also time pdflatex builds')
+    parser.add_argument('--output', metavar='FILE',
+                        help='write the JSON results to FILE instead of standard output')
+    parser.add_argument('--compare', metavar='FILE',
+                        help='print how the results compare to an earlier JSON results FILE')
+    args = parser.parse_args(argv)
+
+    results = run(args.sizes, args.repeat, args.seed, args.latex, print_result)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=1)
+    elif args.compare is None:
+        json.dump(results, sys.stdout, indent=1)
+        print()
+
+    if args.compare is not None:
+        with open(args.compare, "r") as f:
+            before = json.load(f)
+        for name, songs, old, new in compare(before, results):
+            print("{:>6} songs  {:<45} {:10.4f}s {:10.4f}s {:7.2f}x".format(
+                songs, name, old, new, old / new if new > 0 else float("inf")))
@@ -0,0 +1,148 @@
+"""cache.py - On-disk cache of the latex code compiled from song files"""
+
+import hashlib
+import os
+import tempfile
+
+# parser modules whose source makes up the parser version stamp, including
+# transpose.py, whose tables make the fragments of transposed chordsheets
+parser_modules = ["parse.py", "song.py", "transpose.py"]
+
+
+def default_directory():
+    """Returns the default cache directory for this user"""
+    base = os.environ.get("XDG_CACHE_HOME",
+                          os.path.join(os.path.expanduser("~"), ".cache"))
+    return os.path.join(base, "praisetex")
+
+def parser_version():
+    """Returns a stamp that changes whenever the parser source changes"""
+    digest = hashlib.sha1()
+    directory = os.path.dirname(os.path.abspath(__file__))
+    for name in parser_modules:
+        with open(os.path.join(directory, name), "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()
+
+
+class FragmentCache(object):
+    """Least recently used cache of compiled song fragments on disk
+
+    Each fragment is stored in its own file named after the song's content
+    hash, the output mode and the parser version. Entries are written to a
+    temporary file and renamed into place, and missing entries are treated
+    as misses, so several processes can share the same directory.
+    """
+    suffix = ".tex" # filename extension of entries
+    binary = False # whether entries are bytes rather than text
+
+    def __init__(self, directory=None, maxsize=50*1024*1024):
+        if directory is None:
+            directory = default_directory()
+        self.directory = directory
+        self.maxsize = maxsize
+        self.version = parser_version()
+        self.size = None # estimated size of the cache, read on first write
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def key(self, content, mode):
+        """Returns the cache key for a song file's contents in a mode"""
+        digest = hashlib.sha256()
+        digest.update("{}\0{}\0".format(self.version, mode).encode("utf-8"))
+        digest.update(content)
+        return digest.hexdigest()
+
+    def path(self, key):
+        """Returns the filename of a cache entry"""
+        return os.path.join(self.directory, key + self.suffix)
+
+    def get(self, key):
+        """Returns the cached fragment, or None if it is not cached"""
+        path = self.path(key)
+        try:
+            with open(path, "rb" if self.binary else "r") as f:
+                fragment = f.read()
+            os.utime(path, None) # mark as recently used
+        except (IOError, OSError): # missing or evicted by another process
+            return None
+        return fragment
+
+    def put(self, key, fragment):
+        """Store a fragment in the cache"""
+        fd, tmpname = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+        with os.fdopen(fd, "wb" if self.binary else "w") as f:
+            f.write(fragment)
+        os.replace(tmpname, self.path(key))
+
+        if self.size is None:
+            self.size = self.scan_size()
+        else:
+            self.size += len(fragment)
+        if self.size > self.maxsize:
+            self.evict()
+
+    def file_key(self, filename, mode):
+        """Returns the cache key of a song file in a mode"""
+        with open(filename, "rb") as f:
+            return self.key(f.read(), mode)
+
+    def contains(self, key):
+        """Returns True if the fragment is cached, without reading it"""
+        return os.path.isfile(self.path(key))
+
+    def entries(self):
+        """Returns a list of (last used, size, filename) for every entry"""
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(self.suffix):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                stat = os.stat(path)
+            except OSError: # removed by another process
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+
+    def scan_size(self):
+        """Returns the total size of all entries"""
+        return sum(size for used, size, path in self.entries())
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits its size
+
+        Evicts down to three quarters of the size limit, so a full cache is
+        not rescanned on every write.
+        """
+        entries = self.entries()
+        entries.sort()
+        self.size = sum(size for used, size, path in entries)
+        for used, size, path in entries:
+            if self.size <= self.maxsize * 3 // 4:
+                break
+            try:
+                os.remove(path)
+            except OSError: # already evicted by another process
+                pass
+            self.size -= size
+
+    def clear(self):
+        """Remove every entry from the cache"""
+        for used, size, path in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+        self.size = 0
+
+
+class PdfCache(FragmentCache):
+    """Least recently used cache of the PDFs of single songs on disk"""
+    suffix = ".pdf"
+    binary = True
+
+    def __init__(self, directory=None, maxsize=200*1024*1024):
+        if directory is None:
+            directory = os.path.join(default_directory(), "pdf")
+        FragmentCache.__init__(self, directory, maxsize)
@@ -0,0 +1,56 @@
+"""client.py - Building set lists with a running build server
+
+The build server itself is in daemon.py. This module only needs the
+standard library, and only loads urllib once it builds, so
+'praisetex.py --server' starts without loading the server modules.
+"""
+
+import json
+import os
+import tempfile
+
+default_port = 8765
+
+
+class BuildError(Exception):
+    """Raised when a build request fails, with the HTTP status to reply with"""
+    def __init__(self, message, status=400):
+        Exception.__init__(self, message)
+        self.status = status
+
+
+def build(url, songs, mode, output, halfsteps=None, flats=False):
+    """Build a set list with the build server at url, writing the PDF to output
+
+    Raises BuildError with the server's message if the build fails.
+    """
+    import urllib.request # only load http when building through a server
+    import urllib.error
+    request = {"songs": songs, "mode": mode}
+    if halfsteps is not None:
+        request.update(transpose=halfsteps, flats=flats)
+    data = json.dumps(request).encode("utf-8")
+    post = urllib.request.Request(url.rstrip("/") + "/build", data=data,
+                                  headers={"Content-Type": "application/json"})
+    try:
+        with urllib.request.urlopen(post) as response:
+            pdf = response.read()
+    except urllib.error.HTTPError as err:
+        message = err.read().decode("utf-8", "replace").strip()
+        raise BuildError(message or str(err), err.code)
+    except urllib.error.URLError as err:
+        raise BuildError("Cannot reach the build server at {}: {}".format(url, err.reason), 503)
+
+    # replace output only once the whole PDF has arrived, with the mode a
+    # new file gets from the umask
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output)), suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(pdf)
+        umask = os.umask(0o022)
+        os.umask(umask)
+        os.chmod(tmpname, 0o666 & ~umask)
+        os.replace(tmpname, output)
+    except BaseException:
+        os.remove(tmpname)
+        raise
@@ -1,10 +1,30 @@
 """core.py - Provides core classes and function for praiseTex program"""
 
-from collections import deque
-import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+import contextlib
+import io
 import os
+import shutil
 import subprocess
+import tempfile
+import threading
+import time
+import library
 import parse
+import template
+
+try: # pure python PDF library, only needed to join per-song PDFs
+    from pypdf import PdfWriter
+except ImportError:
+    PdfWriter = None
+
+# built-in latex template of each output mode, see PraiseTex.templatePath
+templates = {"chords": "latex/chords.tex",
+             "slides": "latex/slides.tex"}
+
+# name pdflatex gives the job of each output mode
+jobnames = {"chords": "ctmp",
+            "slides": "stmp"}
 
 # regex pattern for any latex command with the form: \command{arg}
 latexCommandPattern = r'\\(\w+)\{([^{]*)\}'
@@ -18,53 +38,152 @@ commandDict = {'title':'songtitle',
 chordCommand = r'\\chord\{([^{}]*)\}|\\chordleft\{([^{}]*)\}|\\chordline\{([^{}]*)\}'
 
 
-class ChordMap(object):
-    """A dictionary of chords used for transposition"""
-    def __init__(self, nHalfSteps, preferSharps=True):
-        self.halfsteps = int(nHalfSteps)
-        if preferSharps:
-            self.chords = ['A', 'A\\#', 'B', 'C', 'C\\#', 'D', 'D\\#', 'E',
-                           'F', 'F\\#', 'G', 'G\\#']
-        else:
-            self.chords = ['A', 'B$\\flat$', 'B', 'C', 'D$\\flat$', 'D',
-                           'E$\\flat$', 'E', 'F', 'G$\\flat$', 'G',
-                           'A$\\flat$']
-
-        # map the original chords to the new transposed ones
-        original = deque(self.chords)
-        transposed = deque(self.chords)
-        transposed.rotate(-nHalfSteps) # shift by number of half steps
-        self.chordDict = dict(zip(original, transposed))
-
-    def __getitem__(self, chord):
-        return self.chordDict[chord]
-
-    def transpose(self, chord):
-        # split by /, space and number
-        chordstr = re.split(r'(/| |\d|m|M|sus|maj)', chord) 
-        newChordList = []
-        for chord in chordstr:
-            if chord in self.chords:
-                chord = self.chordDict[chord]
-            newChordList.append(chord)
-        return ''.join(newChordList)
-
+def renderSong(song, mode, transposer=None):
+    """Return the latex code of a parsed song for 'chords' or 'slides'
+
+    With a transpose.Transposer the chords of chordsheets are transposed.
+    """
+    if transposer is not None and mode == "chords":
+        song = transposer.song(song)
+    return parse.renderers[mode](song)
+
+def compileSongFile(filename, mode, transposer=None):
+    """Return (latex code, None, parsed) for a song file, or (None, error, None)
+
+    parsed is (modification time, size, song.Song), so the caller can reuse
+    the parsed song. Module level function, so it can be sent to a process
+    pool.
+    """
+    try:
+        stat = os.stat(filename)
+        song = parse.parse_song(filename)
+        parsed = (stat.st_mtime, stat.st_size, song)
+        return renderSong(song, mode, transposer), None, parsed
+    except Exception as err:
+        return None, err, None
+
+def parseSongFile(filename):
+    """Return ((modification time, size, song.Song), None) for a song file,
+    or (None, error)
+
+    Module level function, so it can be sent to a process pool.
+    """
+    try:
+        stat = os.stat(filename)
+        return (stat.st_mtime, stat.st_size, parse.parse_song(filename)), None
+    except Exception as err:
+        return None, err
+
+class CompileError(Exception):
+    """Raised when a song file in the compile list cannot be compiled"""
+
+class Cancelled(Exception):
+    """Raised in the compiling thread when compiling has been cancelled"""
+
+
+@contextlib.contextmanager
+def notTimed():
+    """Context manager standing in for a profiler stage when not profiling"""
+    yield
+
+def checkSongFile(filename):
+    """Return a list of (line number, message) of the errors in a song file
+
+    Module level function, so it can be sent to a process pool.
+    """
+    try:
+        return parse.check_song(filename)
+    except (IOError, OSError, UnicodeError) as err:
+        return [(None, str(err))]
+
+def pdflatexCommand(texfile):
+    """Return the pdflatex command line compiling texfile"""
+    return ["pdflatex", "-halt-on-error", "\\pdfminorversion=4",
+            "\\input{" + texfile + "}"]
+
+def terminalCommand(command, jobname):
+    """Return a pdflatex command line reading its document from standard input
+
+    pdflatex names its output after the first file it inputs, so the job is
+    named explicitly instead.
+    """
+    return command[:1] + ["-jobname=" + jobname] + command[1:-1]
+
+def keepLog(directory, jobname, output):
+    """Copy the log of a failed pdflatex job next to output, if there is one"""
+    log = os.path.join(directory, jobname + ".log")
+    if os.path.isfile(log):
+        shutil.copyfile(log, os.path.splitext(output)[0] + ".log")
+
+def umaskMode():
+    """Return the mode files get when created with the user's umask"""
+    umask = os.umask(0o022)
+    os.umask(umask)
+    return 0o666 & ~umask
+
+# mode of created outputs, read once as setting the umask is not thread safe
+outputMode = umaskMode()
+
+def writeOutput(output, write):
+    """Atomically replace output with what write(file) writes to a file
+
+    The file gets the mode os.rename would have left it with, and is
+    removed if write raises.
+    """
+    fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(output)), suffix=".pdf")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.chmod(tmpname, outputMode)
+        os.replace(tmpname, output)
+    except BaseException:
+        os.remove(tmpname)
+        raise
+
+def replaceFile(source, destination):
+    """Atomically replace destination with source, even across filesystems"""
+    try:
+        os.replace(source, destination)
+    except OSError: # source is on another filesystem, copy it next to destination
+        with open(source, "rb") as f:
+            writeOutput(destination, lambda output: shutil.copyfileobj(f, output))
 
 
 class PraiseTex(object):
     """Class for producing chords and slides from song files"""
-    def __init__(self, songdir="songs"):
+    # compile lists shorter than this are compiled without a process pool
+    parallelMinimum = 16
+
+    def __init__(self, songdir="songs", cache=None, workers=None, formats=None,
+                 pdfcache=None, library=None):
         self.songdir = songdir
         #self.songs = {}
         self.songs = []
         self.compile = []
+        self.cache = cache # optional cache.FragmentCache of compiled songs
+        self.parsed = {} # filename -> (modification time, size, song.Song)
+        self.workers = workers # size of process pool, None for all cores
+        self.pool = None # optional process pool shared between builds, see processPool
+        self.formats = formats # optional texformat.FormatCache of preambles
+        self.pdfcache = pdfcache # optional cache.PdfCache of per-song PDFs
+        self.stdout = None # where pdflatex writes its output, None for console
+        self.pipe = False # feed documents to pdflatex's standard input
+        self.progress = None # called with progress messages while compiling
+        self.cancelled = threading.Event() # set by cancel() from any thread
+        self.processes = set() # running subprocesses, for cancel() to kill
+        self.profiler = None # optional profiler.Profiler timing build stages
+        self.library = library # optional library.SongLibrary of songdir
+        self.transposer = None # optional transpose.Transposer for chordsheets
+        self.templateDirs = template.default_directories() # searched before the built-in templates
 
     def refreshSongList(self):
         """Reload the song found in 'songs' directory"""
         del self.songs[:] # delete contents of song list
+        if self.library is not None:
+            return self.library.rescan()
         filenames = os.listdir(self.songdir)
         # keep only song filenames ending with 'txt'
-        songlist = [fn for fn in filenames if fn.endswith('.txt') or fn.endswith('___')]
+        songlist = [fn for fn in filenames if library.is_song_file(fn)]
         songlist.sort() # alphabetize
         return songlist
 
@@ -72,6 +191,8 @@ class PraiseTex(object):
         """Set directory containing song files"""
         if len(directory) > 0:
             self.songdir = directory
+            if self.library is not None:
+                self.library = library.SongLibrary(directory)
 
     def getSongDirectory(self):
         """Return current song directory"""
@@ -90,103 +211,488 @@ class PraiseTex(object):
         if index < len(self.compile):
             self.compile.pop(index)
 
-    def compileChords(self):
-        """Compile a chord sheet from selected songs"""
-        # read in chords template
-        with open("latex/chords.tex", "r") as f:
-            lines = f.readlines()
+    def parsedSong(self, filename, stat=None):
+        """Return the song parsed earlier, or None if the file has changed"""
+        if filename not in self.parsed:
+            return None
+        if stat is None:
+            stat = os.stat(filename)
+        mtime, size, song = self.parsed[filename]
+        if mtime == stat.st_mtime and size == stat.st_size:
+            return song
+        return None
+
+    def parseSong(self, filename):
+        """Return the parsed song file, reusing it until the file changes"""
+        stat = os.stat(filename)
+        song = self.parsedSong(filename, stat)
+        if song is not None:
+            return song
+        song = parse.parse_song(filename)
+        self.parsed[filename] = (stat.st_mtime, stat.st_size, song)
+        return song
+
+    def processPool(self, workers):
+        """Return the shared process pool, or a new one of workers processes
+        to be given back to releasePool"""
+        if self.pool is not None:
+            return self.pool
+        return ProcessPoolExecutor(workers)
+
+    def releasePool(self, pool):
+        """Shut down a pool from processPool, unless it is the shared pool"""
+        if pool is not self.pool:
+            pool.shutdown()
+
+    def parseSongs(self, filenames):
+        """Parse the song files that are not parsed yet, returning a dict of
+        filename -> error for those that cannot be parsed
+
+        Each distinct song file is parsed once, in a process pool when there
+        are enough of them.
+        """
+        unparsed = []
+        for filename in sorted(set(filenames)):
+            if os.path.isfile(filename) and self.parsedSong(filename) is None:
+                unparsed.append(filename)
+
+        workers = self.workers or os.cpu_count() or 1
+        if parse.profiler is not None: # passes in other processes are not recorded
+            workers = 1
+        if workers > 1 and len(unparsed) >= self.parallelMinimum:
+            chunksize = max(1, len(unparsed) // (workers * 4))
+            pool = self.processPool(workers)
+            try:
+                results = list(pool.map(parseSongFile, unparsed, chunksize=chunksize))
+            finally:
+                self.releasePool(pool)
+        else:
+            results = [parseSongFile(filename) for filename in unparsed]
+
+        errors = {}
+        for filename, (parsed, err) in zip(unparsed, results):
+            if err is None:
+                self.parsed[filename] = parsed
+            else:
+                errors[filename] = err
+        return errors
+
+    def cacheMode(self, mode):
+        """Return the mode compiled songs are cached under"""
+        if self.transposer is not None and mode == "chords":
+            return "{} {}".format(mode, self.transposer.name())
+        return mode
+
+    def renderSong(self, song, mode):
+        """Return latex code of a parsed song for 'chords' or 'slides'"""
+        return renderSong(song, mode, self.transposer)
+
+    def checkSongs(self, filenames):
+        """Return a list of (filename, errors) for the song files
+
+        errors is a list of (line number, message), see parse.check_song.
+        Nothing is rendered or typeset, and the files are checked in a
+        process pool when there are enough of them.
+        """
+        workers = self.workers or os.cpu_count() or 1
+        if workers > 1 and len(filenames) >= self.parallelMinimum:
+            chunksize = max(1, len(filenames) // (workers * 4))
+            pool = self.processPool(workers)
+            try:
+                results = list(pool.map(checkSongFile, filenames, chunksize=chunksize))
+            finally:
+                self.releasePool(pool)
+        else:
+            results = [checkSongFile(filename) for filename in filenames]
+        return list(zip(filenames, results))
+
+    def compiledSongs(self, mode):
+        """Yield (filename, latex code, error) for the compile list in order
+
+        Each distinct song file is compiled once, and song files that have
+        not been parsed yet are parsed in a process pool when there are
+        enough of them. Songs are yielded as soon as they are compiled, and
+        latex code is only kept while the compile list repeats its song, so
+        a whole library can be streamed into a document.
+        """
+        filenames = [os.path.join(self.songdir, song) for song in self.compile]
+        remaining = {} # filename -> number of times it is still to be yielded
+        keys = {} # filename -> cache key
+        errors = {} # filename -> error of song files that cannot be read
+        unparsed = [] # distinct song files that are neither cached nor parsed
+        for filename in filenames:
+            if filename in remaining:
+                remaining[filename] += 1
+                continue
+            remaining[filename] = 1
+            if self.cache is not None:
+                try:
+                    keys[filename] = self.cache.file_key(filename, self.cacheMode(mode))
+                except (IOError, OSError) as err:
+                    errors[filename] = err
+                    continue
+                if self.cache.contains(keys[filename]):
+                    continue
+            if os.path.isfile(filename) and self.parsedSong(filename) is None:
+                unparsed.append(filename)
+
+        pool = None
+        workers = self.workers or os.cpu_count() or 1
+        if parse.profiler is not None: # passes in other processes are not recorded
+            workers = 1
+        if workers > 1 and len(unparsed) >= self.parallelMinimum:
+            chunksize = max(1, len(unparsed) // (workers * 4))
+            pool = self.processPool(workers)
+            # results arrive in the order the song files are first yielded
+            results = pool.map(compileSongFile, unparsed, [mode] * len(unparsed),
+                               [self.transposer] * len(unparsed),
+                               chunksize=chunksize)
+        pooled = set(unparsed) if pool is not None else set()
+
+        def compile(filename):
+            if filename in errors:
+                return None, errors[filename]
+            if filename in pooled:
+                songtext, err, parsed = next(results)
+                if parsed is not None:
+                    self.parsed[filename] = parsed
+            else:
+                songtext = None
+                if self.cache is not None:
+                    songtext = self.cache.get(keys[filename])
+                    if songtext is not None:
+                        return songtext, None
+                try:
+                    song = self.parseSong(filename)
+                    songtext, err = self.renderSong(song, mode), None
+                except Exception as error:
+                    songtext, err = None, error
+            if err is None and self.cache is not None:
+                self.cache.put(keys[filename], songtext)
+            return songtext, err
+
+        kept = {} # filename -> (latex code, error) of songs repeated later
+        try:
+            for filename in filenames:
+                if filename in kept:
+                    result = kept[filename]
+                else:
+                    result = compile(filename)
+                remaining[filename] -= 1
+                if remaining[filename] > 0:
+                    kept[filename] = result
+                else:
+                    kept.pop(filename, None)
+                yield (filename,) + result
+        finally:
+            if pool is not None:
+                self.releasePool(pool)
+
+    def runPdflatex(self, template, jobname, songtexts, directory="."):
+        """Write a template.Template with its songs to jobname.tex and
+        compile it, returning the error
+
+        songtexts may be any iterable of strings, such as a generator of
+        songs, and is written out as it is produced. Uses a precompiled
+        format of the template's preamble if one can be built, falling back
+        to compiling the whole document if pdflatex cannot load it.
+        """
+        texfile = jobname + ".tex"
+        path = os.path.join(directory, texfile)
+        fmt = None
+        if self.formats is not None:
+            with self.timed("load format"):
+                fmt = self.formats.get(template.filename, template.preamble_lines)
+        if fmt is None:
+            return self.streamPdflatex(pdflatexCommand(texfile), path,
+                                       template.document(songtexts))
+
+        # preamble is already loaded from the format
+        log = os.path.join(directory, jobname + ".log")
+        if os.path.isfile(log): # tell this run's log from an earlier one
+            os.remove(log)
+        error = self.streamPdflatex(self.formats.command(fmt, texfile), path,
+                                    template.body(songtexts),
+                                    env=self.formats.environment())
+        if not error or not self.formats.load_failed(log):
+            return error # a latex error would only happen again
+        self.formats.discard(fmt)
+
+        # put the preamble back in front of the body and compile it all
+        with self.timed("write tex file"):
+            with open(path + ".full", "w") as f:
+                f.write(template.preamble)
+                with open(path, "r") as body:
+                    shutil.copyfileobj(body, f)
+            os.replace(path + ".full", path)
+        with self.timed("pdflatex"):
+            return self.call(pdflatexCommand(texfile), cwd=directory,
+                             stdout=self.stdout)
+
+    def streamPdflatex(self, command, path, document, env=None):
+        """Write document to path and run the pdflatex command on it
+
+        If pipe is set, pdflatex is started first and reads the document
+        from its standard input as it is produced, so it typesets while the
+        songs are still being compiled. Returns the error of pdflatex.
+        """
+        directory = os.path.dirname(path)
+        if not self.pipe:
+            with self.timed("write tex file"):
+                with open(path, "w") as f:
+                    f.writelines(document)
+            self.report("Running pdflatex")
+            with self.timed("pdflatex"):
+                return self.call(command, env=env, cwd=directory, stdout=self.stdout)
+
+        with self.timed("pdflatex with piped document"):
+            return self.pipePdflatex(command, path, document, env)
+
+    def pipePdflatex(self, command, path, document, env):
+        """Run the pdflatex command on a document fed to its standard input
+
+        The document is written to path as well, to fall back on.
+        """
+        directory = os.path.dirname(path)
+        jobname = os.path.splitext(os.path.basename(path))[0]
+        process = self.start(terminalCommand(command, jobname),
+                             stdin=subprocess.PIPE, env=env, cwd=directory,
+                             stdout=self.stdout, universal_newlines=True)
+        try:
+            feeding = True
+            with open(path, "w") as f: # keep a copy to fall back on
+                for chunk in document:
+                    f.write(chunk)
+                    if not feeding:
+                        continue
+                    try:
+                        process.stdin.write(chunk)
+                        process.stdin.flush()
+                    except BrokenPipeError: # pdflatex has stopped on an error
+                        feeding = False
+            try:
+                process.stdin.close()
+            except BrokenPipeError:
+                pass
+        except BaseException: # do not leave pdflatex waiting for input
+            process.kill()
+            self.wait(process)
+            raise
+        return self.wait(process)
+
+    def start(self, command, **kwargs):
+        """Start a subprocess that cancel() can kill"""
+        if self.cancelled.is_set():
+            raise Cancelled()
+        process = subprocess.Popen(command, **kwargs)
+        self.processes.add(process)
+        if self.cancelled.is_set(): # cancelled while starting
+            process.kill()
+        return process
+
+    def wait(self, process):
+        """Wait for a subprocess, raising Cancelled if it has been cancelled"""
+        try:
+            error = process.wait()
+        finally:
+            self.processes.discard(process)
+        if self.cancelled.is_set():
+            raise Cancelled()
+        return error
 
-        # find line number ranges where \input{song.tex} should be
-        begin = lines.index("\\begin{multicols}{2}\n") + 1
-        end = lines.index("\\end{multicols}\n")
-        top = lines[:begin]
-        bottom = lines[end:]
+    def call(self, command, **kwargs):
+        """Run a command like subprocess.call, but one that cancel() can kill"""
+        return self.wait(self.start(command, **kwargs))
 
-        # create text from template and songs to pass to pdflatex
-        ctmp = []
-        ctmp.extend(top)
-        # count = 0
-        for song in self.compile:
-            fullpathfilename = os.path.join(self.songdir, song)
-            try:
-                songtext = parse.compile_chords(fullpathfilename)
-                ctmp.append(songtext)
-            except Exception as err:
-                print("Error in file: {}".format(fullpathfilename))
-                print(err)
-                exit()
-            # with open('tmp/{}.tex'.format(song.replace('.txt', '')), 'w') as f:
-            #     f.writelines(top)
-            #     f.writelines(songtext)
-            #     f.writelines(bottom)
-            # count += 1
-            
-        ctmp.extend(bottom)
-        with open("ctmp.tex", "w") as f:
-            f.writelines(ctmp)
-
-        # compile document
-        error = subprocess.call(["pdflatex", "-halt-on-error", "\\pdfminorversion=4", "\\input{ctmp.tex}"])
-
-        if not error:
-            if os.path.isfile("chords.pdf"):
-                os.remove("chords.pdf")
-            os.rename("ctmp.pdf", "chords.pdf")
-
-        # remove temporary files
-        fnames = os.listdir('.')
-        for f in fnames:
-            if "ctmp" in f:
-                os.remove(f)
+    def cancel(self):
+        """Stop compiling, killing any running pdflatex
 
+        Safe to call from another thread. The compiling thread raises
+        Cancelled, and compiling stays cancelled until cancelled is cleared.
+        """
+        self.cancelled.set()
+        for process in list(self.processes):
+            try:
+                process.kill()
+            except OSError: # already finished
+                pass
+
+    def timed(self, stage):
+        """Return a context manager recording a stage of the build with the
+        profiler, or doing nothing without one"""
+        if self.profiler is None:
+            return notTimed()
+        return self.profiler.stage(stage)
+
+    def report(self, message):
+        """Pass a progress message to the progress callback, if any"""
+        if self.progress is not None:
+            self.progress(message)
+
+    def buildPdf(self, template, jobname, songtexts, output):
+        """Compile a template with its songs in a temporary directory and
+        move the PDF to output
+
+        Every build gets its own directory, so builds can run concurrently,
+        and output is only replaced once pdflatex has succeeded. If it fails,
+        its log is kept next to output.
+        """
+        directory = tempfile.mkdtemp(prefix="praisetex")
+        try:
+            error = self.runPdflatex(template, jobname, songtexts, directory)
+            pdf = os.path.join(directory, jobname + ".pdf")
+            if not error and not os.path.isfile(pdf): # no pages of output
+                error = 1
+            if not error:
+                replaceFile(pdf, output)
+            else:
+                keepLog(directory, jobname, output)
+        finally:
+            shutil.rmtree(directory) # remove temporary files
         return error
 
-    def compileSlides(self):
-        """Compile slides from selected songs"""
-        # read in chords template
-        with open("latex/slides.tex", "r") as f:
-            lines = f.readlines()
-
-        # find line number ranges where \input{song.tex} should be
-        begin = lines.index("\\begin{document}\n") + 1
-        end = lines.index("\\end{document}\n")
-        top = lines[:begin]
-        bottom = lines[end:]
+    def songPdf(self, template, songtext, output):
+        """Return the PDF of a single song, compiling it if it is not cached
+
+        Returns b"" for a song without any pages, such as a column break,
+        and None if pdflatex fails, keeping its log next to output.
+        """
+        if len(songtext.strip()) == 0:
+            return b""
+        content = template.text + '\0' + songtext
+        key = self.pdfcache.key(content.encode("utf-8"), template.filename)
+        pdf = self.pdfcache.get(key)
+        if pdf is not None:
+            return pdf
+
+        directory = tempfile.mkdtemp(prefix="praisetex")
+        try:
+            filename = os.path.join(directory, "song.pdf")
+            if self.runPdflatex(template, "song", [songtext], directory):
+                keepLog(directory, "song", output)
+                return None
+            pdf = b""
+            if os.path.isfile(filename): # else pdflatex had no pages of output
+                with open(filename, "rb") as f:
+                    pdf = f.read()
+        finally:
+            shutil.rmtree(directory)
+        self.pdfcache.put(key, pdf)
+        return pdf
+
+    def assemblePdf(self, template, songtexts, output):
+        """Build output by joining the cached PDF of each song
+
+        Each song starts on a new page, and only songs that are not cached
+        are run through pdflatex. Returns the error like runPdflatex.
+        """
+        writer = PdfWriter()
+        for songtext in songtexts:
+            pdf = self.songPdf(template, songtext, output)
+            if pdf is None:
+                return 1
+            if len(pdf) > 0:
+                writer.append(io.BytesIO(pdf))
+
+        with self.timed("join pdfs"):
+            writeOutput(output, writer.write)
+        return 0
+
+    def songTexts(self, mode):
+        """Yield the latex code of every song in the compile list for a mode
+
+        Raises CompileError if a song file cannot be compiled, and Cancelled
+        once compiling has been cancelled.
+        """
+        total = len(self.compile)
+        songs = self.compiledSongs(mode)
+        for number, (fullpathfilename, songtext, err) in enumerate(songs, 1):
+            if self.cancelled.is_set():
+                raise Cancelled()
+            if err is not None:
+                raise CompileError("Error in file: {}\n{}".format(fullpathfilename, err))
+            self.report("Compiled {} song {} of {}".format(mode, number, total))
+            if mode == "slides":
+                songtext = songtext + r"\pagebreak"
+            yield songtext
+
+    def compileOutputs(self, outputs, workers=2, report=None, songtexts=None):
+        """Compile several documents at once, returning {mode: (error, seconds)}
+
+        outputs maps 'chords' and/or 'slides' to output filenames. The songs
+        are compiled for every mode first, unless songtexts maps each mode
+        to its song texts already, then the pdflatex jobs run in up to
+        workers threads with their console output silenced. report, if
+        given, is called with (mode, error, seconds) as each job finishes.
+        """
+        builders = {"chords": self.compileChords, "slides": self.compileSlides}
+        if songtexts is None:
+            # compiled up front, so a bad song file stops before any job starts
+            with self.timed("compile songs"):
+                songtexts = dict((mode, list(self.songTexts(mode))) for mode in outputs)
+
+        def build(mode):
+            start = time.time()
+            error = builders[mode](outputs[mode], songtexts[mode])
+            return error, time.time() - start
+
+        stdout = self.stdout
+        if len(outputs) > 1 and workers > 1:
+            self.stdout = subprocess.DEVNULL # keep jobs from interleaving
+        results = {}
+        try:
+            with ThreadPoolExecutor(workers) as pool:
+                futures = dict((pool.submit(build, mode), mode) for mode in outputs)
+                for future in as_completed(futures):
+                    mode = futures[future]
+                    results[mode] = future.result()
+                    if report is not None:
+                        report(mode, *results[mode])
+        finally:
+            self.stdout = stdout
+        return results
+
+    def templatePath(self, mode):
+        """Return the template file of a mode, from the template directories
+        if one of them has it"""
+        return template.find(templates[mode], self.templateDirs)
+
+    def loadTemplate(self, mode):
+        """Return the template.Template of a mode
+
+        Raises CompileError if it has no place for the songs.
+        """
+        path = self.templatePath(mode)
+        try:
+            return template.load(path)
+        except template.TemplateError as err:
+            raise CompileError("Error in template: {}\n{}".format(path, err))
+
+    def compileDocument(self, mode, output, songtexts=None):
+        """Compile the selected songs into output for a mode"""
+        with self.timed("read template"):
+            document = self.loadTemplate(mode)
 
         # create text from template and songs to pass to pdflatex
-        stmp = []
-        stmp.extend(top)
-        for song in self.compile:
-            fullpathfilename = os.path.join(self.songdir, song)
-            try:
-                songtext = parse.compile_slides(fullpathfilename)
-                stmp.append(songtext + r"\pagebreak")
-                print(songtext)
-            except Exception as err:
-                print("Error in file: {}".format(fullpathfilename))
-                print(err)
-                exit()
-
-        stmp.extend(bottom)
-        with open("stmp.tex", "w") as f:
-            f.writelines(stmp)
-
-        # compile document
-        error = subprocess.call(["pdflatex", "-halt-on-error",  "\\pdfminorversion=4", "\\input{stmp.tex}"])
-        
-        if not error:
-            if os.path.isfile("slides.pdf"):
-                os.remove("slides.pdf")
-            os.rename("stmp.pdf", "slides.pdf")
-
-        # remove temporary files
-        fnames = os.listdir('.')
-        for f in fnames:
-            if "stmp" in f:
-                os.remove(f)
+        if songtexts is None:
+            songtexts = self.songTexts(mode)
+            if self.profiler is not None: # keep compiling out of the other stages
+                with self.timed("compile songs"):
+                    songtexts = list(songtexts)
 
-        return error
+        if self.pdfcache is not None and PdfWriter is not None:
+            return self.assemblePdf(document, songtexts, output)
+
+        # stream the template and songs to pdflatex as songs are compiled
+        return self.buildPdf(document, jobnames[mode], songtexts, output)
 
+    def compileChords(self, output="chords.pdf", songtexts=None):
+        """Compile a chord sheet from selected songs"""
+        return self.compileDocument("chords", output, songtexts)
+
+    def compileSlides(self, output="slides.pdf", songtexts=None):
+        """Compile slides from selected songs"""
+        return self.compileDocument("slides", output, songtexts)
 
 if __name__ == '__main__':
     p = PraiseTex()
@@ -0,0 +1,218 @@
+"""daemon.py - A local build server keeping songs and templates loaded
+
+Every run of praisetex.py starts Python, parses its songs and reads the
+templates again. The build server does this once and keeps the parsed
+songs, compiled song fragments, templates and pdflatex formats between
+builds. It listens on localhost over HTTP:
+
+POST /build  with a JSON object {"songs": [song files], "mode": "chords"
+             or "slides", "transpose": half steps, "flats": true or false}
+             replies with the PDF, or a text message and an error status
+GET /songs   replies with a JSON list of the song files and their headers
+
+Start it with 'praisetex.py --daemon' and build through it with
+'praisetex.py --server http://127.0.0.1:8765 -c song.txt', see client.py.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import http.server
+import json
+import multiprocessing
+import os
+import shutil
+import socketserver
+import subprocess
+import tempfile
+import threading
+
+import cache
+from client import BuildError, default_port
+import core
+import library
+import texformat
+import transpose
+
+# largest build request accepted, in bytes
+maxRequest = 1024 * 1024
+
+# headers of each song listed by GET /songs
+songFields = ["title", "by", "capo", "key", "comment", "order"]
+
+
+def poolContext():
+    """Return the multiprocessing context of the build server's process pool"""
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        return multiprocessing.get_context("forkserver")
+    return multiprocessing.get_context("spawn")
+
+
+class BuildServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    """HTTP server building set lists, each request in its own thread
+
+    Every build gets its own core.PraiseTex, so concurrent builds never
+    share a compile list or transposer, while the parsed songs, fragment
+    cache and pdflatex formats are shared by all of them. Songs are
+    compiled as soon as a request arrives, but at most jobs builds run
+    pdflatex at once.
+
+    New songs are parsed in one process pool kept for the life of the
+    server. Its processes are started from a forkserver rather than forked
+    from a request thread, which could copy a lock, such as song.chord_lock,
+    held by another build and hang.
+    """
+    daemon_threads = True # do not wait for open connections when stopping
+
+    def __init__(self, address=("127.0.0.1", default_port), songdir="songs",
+                 jobs=2, workers=None, pipe=False, pdfcache=None, templatedirs=()):
+        http.server.HTTPServer.__init__(self, address, BuildHandler)
+        self.songdir = songdir
+        self.workers = workers # size of process pool parsing new songs
+        self.pipe = pipe # feed documents to pdflatex's standard input
+        self.cache = cache.FragmentCache()
+        self.formats = texformat.FormatCache()
+        self.pdfcache = pdfcache # optional cache.PdfCache of per-song PDFs
+        self.templatedirs = list(templatedirs) # searched before the user's own
+        self.parsed = {} # shared by every build, see core.PraiseTex.parsed
+        self.library = library.SongLibrary(songdir)
+        self.lock = threading.Lock() # guards the library
+        self.builds = threading.BoundedSemaphore(jobs)
+        self.pool = ProcessPoolExecutor(workers, mp_context=poolContext())
+
+    def server_close(self):
+        http.server.HTTPServer.server_close(self)
+        self.pool.shutdown()
+
+    def songFiles(self):
+        """Return the song files in the song directory"""
+        with self.lock:
+            return self.library.rescan()
+
+    def songs(self):
+        """Return a list of the song files with their headers"""
+        with self.lock:
+            filenames = self.library.rescan()
+            entries = [(filename, self.library.get(filename)) for filename in filenames]
+        songs = []
+        for filename, entry in entries:
+            song = dict((field, entry.get(field)) for field in songFields)
+            song["file"] = filename
+            songs.append(song)
+        return songs
+
+    def praisetex(self, request):
+        """Return a new core.PraiseTex for a build request, sharing the
+        server's parsed songs and caches"""
+        songs = request.get("songs")
+        if not isinstance(songs, list) or len(songs) == 0:
+            raise BuildError("No songs to build")
+        available = set(self.songFiles())
+        for song in songs:
+            if not isinstance(song, str) or song not in available:
+                raise BuildError("Song file not found: {}".format(song), 404)
+
+        praisetex = core.PraiseTex(self.songdir, cache=self.cache, workers=self.workers,
+                                   formats=self.formats, pdfcache=self.pdfcache)
+        praisetex.parsed = self.parsed
+        praisetex.pool = self.pool
+        praisetex.pipe = self.pipe
+        praisetex.templateDirs = self.templatedirs + praisetex.templateDirs
+        praisetex.stdout = subprocess.DEVNULL # keep builds from interleaving
+        halfsteps = request.get("transpose")
+        if halfsteps is not None:
+            if not isinstance(halfsteps, int):
+                raise BuildError("transpose must be a number of half steps")
+            praisetex.transposer = transpose.Transposer(halfsteps,
+                                                        not request.get("flats", False))
+        for index, song in enumerate(songs):
+            praisetex.addSong(index, song)
+        return praisetex
+
+    def build(self, request):
+        """Build the PDF of a build request, returning its contents"""
+        mode = request.get("mode", "chords")
+        if mode not in core.templates:
+            raise BuildError("Unknown mode: {}".format(mode))
+        praisetex = self.praisetex(request)
+        try:
+            songtexts = list(praisetex.songTexts(mode))
+        except core.CompileError as err:
+            raise BuildError(str(err), 422)
+
+        builders = {"chords": praisetex.compileChords, "slides": praisetex.compileSlides}
+        directory = tempfile.mkdtemp(prefix="praisetex-daemon")
+        try:
+            output = os.path.join(directory, mode + ".pdf")
+            with self.builds:
+                error = builders[mode](output, songtexts)
+            if error:
+                message = "pdflatex has failed"
+                log = os.path.join(directory, mode + ".log")
+                if os.path.isfile(log):
+                    with open(log, "r", errors="replace") as f:
+                        message += "\n" + ''.join(f.readlines()[-20:])
+                raise BuildError(message, 500)
+            with open(output, "rb") as f:
+                return f.read()
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+class BuildHandler(http.server.BaseHTTPRequestHandler):
+    """Handles the requests to a BuildServer"""
+    server_version = "praisetex"
+
+    def do_GET(self):
+        if self.path != "/songs":
+            self.reply(404, "text/plain; charset=utf-8", b"Not found\n")
+            return
+        songs = json.dumps(self.server.songs(), indent=1)
+        self.reply(200, "application/json", songs.encode("utf-8"))
+
+    def do_POST(self):
+        if self.path != "/build":
+            self.reply(404, "text/plain; charset=utf-8", b"Not found\n")
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            if length > maxRequest:
+                raise BuildError("Build request is too large", 413)
+            try:
+                request = json.loads(self.rfile.read(length).decode("utf-8"))
+            except ValueError:
+                raise BuildError("Build request is not JSON")
+            if not isinstance(request, dict):
+                raise BuildError("Build request must be a JSON object")
+            pdf = self.server.build(request)
+        except BuildError as err:
+            self.reply(err.status, "text/plain; charset=utf-8",
+                       (str(err) + "\n").encode("utf-8"))
+            return
+        except Exception as err: # keep serving other builds
+            self.reply(500, "text/plain; charset=utf-8",
+                       "Build failed: {}\n".format(err).encode("utf-8"))
+            return
+        self.reply(200, "application/pdf", pdf)
+
+    def reply(self, status, contenttype, body):
+        """Send a whole reply"""
+        self.send_response(status)
+        self.send_header("Content-Type", contenttype)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+def serve(port=default_port, **options):
+    """Run a BuildServer on localhost until interrupted
+
+    options are passed on to BuildServer.
+    """
+    server = BuildServer(("127.0.0.1", port), **options)
+    print("Build server listening on http://127.0.0.1:{}, press Ctrl-C to stop".format(
+        server.server_address[1]))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopped build server")
+    finally:
+        server.server_close()
@@ -5,18 +5,20 @@ import sys
 if sys.version_info[:2] == (2, 7): # if using python2.7+
     try:
         from Tkinter import Tk, Menu, Frame, Label, Listbox, Button, \
-            Scrollbar, VERTICAL, EXTENDED, LEFT, RIGHT, TOP, BOTTOM, \
-            Y, W, END
+            Scrollbar, Entry, StringVar, Toplevel, Text, VERTICAL, EXTENDED, \
+            LEFT, RIGHT, TOP, BOTTOM, BOTH, NONE, X, Y, W, END, NORMAL, DISABLED
         import tkFileDialog as filedialog
+        import Queue as queue
     except ImportError:
         raise ImportError("Tkinter for Python is not installed")
 
 elif sys.version_info[0] == 3:
     try: # if using python3.x+
         from tkinter import Tk, Menu, Frame, Label, Listbox, Button, \
-            Scrollbar, VERTICAL, EXTENDED, LEFT, RIGHT, TOP, BOTTOM, \
-            Y, W, END
+            Scrollbar, Entry, StringVar, Toplevel, Text, VERTICAL, EXTENDED, \
+            LEFT, RIGHT, TOP, BOTTOM, BOTH, NONE, X, Y, W, END, NORMAL, DISABLED
         from tkinter import filedialog
+        import queue
         from tkinter.ttk import Scrollbar
     except ImportError:
         raise ImportError("Tkinter for Python is not installed")
@@ -24,15 +26,34 @@ elif sys.version_info[0] == 3:
 else:
     raise "Must use Python version 2.7+ or 3.x+"
 
-from core import PraiseTex
+import os
+import threading
+
+from core import PraiseTex, CompileError, Cancelled
+from cache import FragmentCache
+from texformat import FormatCache
+from library import SongLibrary
+from search import SearchIndex
+import preview
 
 
 class PraiseTexGUI(object):
     """Graphical interface for selecting songs and compiling them"""
+    # milliseconds between checks for messages from the compiling thread
+    pollInterval = 100
+
     def __init__(self, songdir="songs"):
         # data
         self.songs = []
-        self.praisetex = PraiseTex(songdir)
+        self.shownSongs = [] # song files in the available songs list
+        self.praisetex = PraiseTex(songdir, cache=FragmentCache(),
+                                   formats=FormatCache(),
+                                   library=SongLibrary(songdir))
+        self.searchIndex = SearchIndex(self.praisetex.library)
+        self.messages = queue.Queue() # status messages from the compiling thread
+        self.praisetex.progress = self.messages.put
+        self.worker = None # thread compiling songs
+        self.previewWindow = None # window previewing the selected song
         self.root = Tk()
         
         button_width = 6
@@ -72,6 +93,11 @@ class PraiseTexGUI(object):
         self.availableSongsFrame = Frame(self.root)
         self.availableSongsFrame.grid(row=1, column=0,
                                       padx=frame_padx, pady=frame_pady)
+        self.searchText = StringVar()
+        self.searchEntry = Entry(self.availableSongsFrame,
+                                 textvariable=self.searchText)
+        self.searchEntry.pack(side=TOP, fill=X)
+        self.searchText.trace_add("write", self.searchSongs)
         self.availableSongsScroll = Scrollbar(self.availableSongsFrame, 
                                               orient=VERTICAL)
         self.availableSongs = Listbox(self.availableSongsFrame, 
@@ -83,6 +109,7 @@ class PraiseTexGUI(object):
         self.availableSongsScroll.config(command=self.availableSongs.yview)
         self.availableSongsScroll.pack(side=RIGHT, fill=Y)
         self.availableSongs.pack()
+        self.availableSongs.bind("<<ListboxSelect>>", self.updatePreview)
 
         self.button = Button(self.root, 
                              text="Refresh",  
@@ -101,6 +128,10 @@ class PraiseTexGUI(object):
                                        text="Remove", 
                                        command=self.removeSong)
         self.removeSongButton.pack(side=BOTTOM)
+        self.previewButton = Button(self.root,
+                                    text="Preview",
+                                    command=self.showPreview)
+        self.previewButton.grid(row=2, column=1)
 
         # right section
         self.songsToCompileTitle = Label(self.root, text="Songs to Compile", 
@@ -132,7 +163,12 @@ class PraiseTexGUI(object):
         self.slidesButton = Button(self.compileButtonFrame, 
                                    text="Slides", 
                                    command=self.compileSlides)
-        self.slidesButton.pack(side=RIGHT, padx=button_padx, pady=button_pady)
+        self.slidesButton.pack(side=LEFT, padx=button_padx, pady=button_pady)
+        self.cancelButton = Button(self.compileButtonFrame,
+                                   text="Cancel",
+                                   command=self.cancelCompile,
+                                   state=DISABLED)
+        self.cancelButton.pack(side=RIGHT, padx=button_padx, pady=button_pady)
 
         # status bar
         self.status = Label(self.root, text="Ready", padx="1m")
@@ -146,15 +182,37 @@ class PraiseTexGUI(object):
 
     def refreshSongList(self):
         """Sync up the filenames in songlist with files in directory"""
-        # clear song list
-        self.availableSongs.delete(0, END)
-
         # add song files
         self.songs = self.praisetex.refreshSongList()
-        for song in self.songs:
-            self.availableSongs.insert(END, song)
+        if self.searchIndex.library is not self.praisetex.library:
+            # song directory has changed
+            self.searchIndex = SearchIndex(self.praisetex.library)
+        self.searchIndex.refresh()
+        self.showSongs(self.songs)
         self.updateStatus("{0} songs found in directory {1}".format(len(self.songs), self.praisetex.getSongDirectory()))
 
+    def songLabel(self, filename):
+        """Returns how a song file is shown: its title, key and capo"""
+        return self.praisetex.library.describe(filename, by=False)
+
+    def showSongs(self, songs):
+        """Replace the available songs with the given song files"""
+        self.shownSongs = list(songs)
+        self.availableSongs.delete(0, END)
+        for song in songs:
+            self.availableSongs.insert(END, self.songLabel(song))
+
+    def searchSongs(self, *args):
+        """Show only the available songs matching the search box"""
+        query = self.searchText.get()
+        if len(query.strip()) == 0:
+            self.showSongs(self.songs)
+            self.updateStatus("{0} songs found in directory {1}".format(len(self.songs), self.praisetex.getSongDirectory()))
+            return
+        results = self.searchIndex.search(query)
+        self.showSongs([filename for filename, line in results])
+        self.updateStatus("{0} songs match '{1}'".format(len(results), query))
+
     def openDirectory(self):
         """Selects directory for songs"""
         dirname = filedialog.askdirectory(parent=self.root, initialdir=self.praisetex.getSongDirectory(), title='Please select a directory')
@@ -179,27 +237,27 @@ class PraiseTexGUI(object):
             
         elif len(selectedSongs) == 1: # insert the one song
             song = selectedSongs[0]
-            songtitle = self.availableSongs.get(song)
+            songtitle = self.shownSongs[int(song)]
             if insertIndex == -1:
                 end = len(self.praisetex.compile)
                 self.praisetex.addSong(end, songtitle)
-                self.songsToCompile.insert(END, songtitle)
+                self.songsToCompile.insert(END, self.songLabel(songtitle))
             else:
                 self.praisetex.addSong(insertIndex+1, songtitle)
-                self.songsToCompile.insert(insertIndex+1, songtitle)
+                self.songsToCompile.insert(insertIndex+1, self.songLabel(songtitle))
             
         else: # more than one song  
-            songList = [self.availableSongs.get(song) for song in selectedSongs]
+            songList = [self.shownSongs[int(song)] for song in selectedSongs]
             if insertIndex != -1:
                 songList.reverse()
                 for songtitle in songList:
                     self.praisetex.addSong(insertIndex+1, songtitle)
-                    self.songsToCompile.insert(insertIndex+1, songtitle)
+                    self.songsToCompile.insert(insertIndex+1, self.songLabel(songtitle))
             else: # add songs to the end
                 for songtitle in songList:
                     end = len(self.praisetex.compile)
                     self.praisetex.addSong(end, songtitle)
-                    self.songsToCompile.insert(END, songtitle)
+                    self.songsToCompile.insert(END, self.songLabel(songtitle))
        
         self.updateStatus("{0} songs added".format(len(selectedSongs)))
 
@@ -214,23 +272,104 @@ class PraiseTexGUI(object):
             
         self.updateStatus("{0} songs removed".format(len(songindexes)))
 
+    def showPreview(self):
+        """Open a window previewing the selected available song, which
+        follows the selection until it is closed"""
+        if self.previewWindow is None:
+            self.previewWindow = Toplevel(self.root)
+            self.previewWindow.title("Preview")
+            self.previewWindow.protocol("WM_DELETE_WINDOW", self.closePreview)
+            self.previewText = Text(self.previewWindow, width=60, height=30,
+                                    font=("TkFixedFont", 12), wrap=NONE)
+            self.previewText.pack(fill=BOTH, expand=True)
+        self.updatePreview()
+
+    def updatePreview(self, *args):
+        """Show the selected available song in the preview window"""
+        selected = self.availableSongs.curselection()
+        if self.previewWindow is None or len(selected) == 0:
+            return
+        filename = self.shownSongs[int(selected[0])]
+        path = os.path.join(self.praisetex.getSongDirectory(), filename)
+        try:
+            text = preview.render_text(self.praisetex.parseSong(path))
+        except Exception as err:
+            text = "Cannot preview {0}: {1}".format(filename, err)
+        self.previewText.config(state=NORMAL)
+        self.previewText.delete("1.0", END)
+        self.previewText.insert(END, text)
+        self.previewText.config(state=DISABLED)
+
+    def closePreview(self):
+        """Close the preview window"""
+        self.previewWindow.destroy()
+        self.previewWindow = None
+
     def compileChords(self):
         """Compile a chord sheet from selected songs"""
-        self.updateStatus("Compiling Songs")
-        error = self.praisetex.compileChords()
-        if error:
-            self.updateStatus("pdflatex has failed")
-        else:
-            self.updateStatus("Compiled chords.pdf")
+        self.startCompile(self.praisetex.compileChords, "chords.pdf")
 
     def compileSlides(self):
         """Compile slides from selected songs"""
+        self.startCompile(self.praisetex.compileSlides, "slides.pdf")
+
+    def startCompile(self, compile, output):
+        """Compile in a worker thread, keeping the window responsive"""
+        if self.worker is not None:
+            return
+        self.chordsButton.config(state=DISABLED)
+        self.slidesButton.config(state=DISABLED)
+        self.cancelButton.config(state=NORMAL)
         self.updateStatus("Compiling Songs")
-        error = self.praisetex.compileSlides()
-        if error:
-            self.updateStatus("pdflatex has failed")
-        else:
-            self.updateStatus("Compiled slides.pdf")
+        self.praisetex.cancelled.clear()
+        self.worker = threading.Thread(target=self.runCompile,
+                                       args=(compile, output))
+        self.worker.daemon = True # do not keep a closed window running
+        self.worker.start()
+        self.root.after(self.pollInterval, self.showMessages)
+
+    def runCompile(self, compile, output):
+        """Compile in the worker thread, reporting through the message queue"""
+        try:
+            if compile():
+                message = "pdflatex has failed"
+            else:
+                message = "Compiled {0}".format(output)
+        except Cancelled:
+            message = "Compiling cancelled"
+        except CompileError as err:
+            message = str(err).replace("\n", ": ")
+        except Exception as err:
+            message = "Compiling failed: {0}".format(err)
+        self.messages.put(message)
+        self.messages.put(None) # compiling has finished
+
+    def showMessages(self):
+        """Show the messages from the worker thread in the status bar"""
+        while True:
+            try:
+                message = self.messages.get_nowait()
+            except queue.Empty:
+                break
+            if message is None:
+                self.finishCompile()
+                return
+            self.updateStatus(message)
+        self.root.after(self.pollInterval, self.showMessages)
+
+    def finishCompile(self):
+        """Get ready for the next compile once the worker thread is done"""
+        self.worker.join()
+        self.worker = None
+        self.chordsButton.config(state=NORMAL)
+        self.slidesButton.config(state=NORMAL)
+        self.cancelButton.config(state=DISABLED)
+
+    def cancelCompile(self):
+        """Cancel compiling, stopping pdflatex if it is running"""
+        if self.worker is not None:
+            self.praisetex.cancel()
+            self.updateStatus("Cancelling")
 
     def updateStatus(self, message):
         """Update the status bar"""
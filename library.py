@@ -0,0 +1,174 @@
+"""library.py - Persistent index of the song files in a song directory"""
+
+import hashlib
+import json
+import os
+import tempfile
+
+import cache
+import parse
+import song as s
+
+
+def default_index(songdir):
+    """Returns the default index filename for a song directory"""
+    digest = hashlib.sha1(os.path.abspath(songdir).encode("utf-8"))
+    name = "library-{}.json".format(digest.hexdigest()[:16])
+    return os.path.join(cache.default_directory(), name)
+
+def is_song_file(filename):
+    """Check if a filename in the song directory is a song file"""
+    return filename.endswith('.txt') or filename.endswith('___')
+
+def read_header(filename):
+    """Returns the header of a song file, reading only as far as needed
+
+    See parse.scan_header. Returns None if the file cannot be read.
+    """
+    try:
+        with open(filename, "r") as f:
+            return parse.scan_header(f)
+    except (OSError, UnicodeError):
+        return None
+
+def song_metadata(text):
+    """Returns a dictionary of the header, stanza names and lyrics of the
+    text of a song file
+
+    Each line is only lexed, the song is not parsed.
+    """
+    metadata = dict((command, None) for command in parse.header_commands)
+    metadata.update(stanzas=[], lyrics=[])
+    lines = text.split('\n')
+    metadata.update(parse.scan_header(lines))
+    in_stanza = False
+    for line in lines:
+        kind, chords = s.lex_line(line)
+        if kind == s.HEADER:
+            name = line.split(':', 1)[0].strip()
+            in_stanza = len(name) > 0 and name.split()[0].lower() in parse.stanza_commands
+            if in_stanza:
+                metadata["stanzas"].append(name)
+        elif in_stanza and kind == s.LYRICS:
+            metadata["lyrics"].append(line.strip())
+    return metadata
+
+def describe(filename, header, by=True):
+    """Returns the title of a song, with its author, key and capo if known
+
+    header is its index entry or parse.scan_header result, or None. The
+    author is left out unless by is true.
+    """
+    if header is None or not header.get("title"):
+        return filename
+    description = header["title"]
+    if by and header.get("by"):
+        description += " by " + header["by"]
+    details = []
+    if header.get("key"):
+        details.append(header["key"])
+    if header.get("capo"):
+        details.append("capo " + header["capo"])
+    if len(details) > 0:
+        description += " [{}]".format(", ".join(details))
+    return description
+
+
+class SongLibrary(object):
+    """Index of the song files in a directory, kept on disk between runs
+
+    Each entry holds a song file's modification time, size, content hash,
+    metadata and lyric lines. A rescan only reads files whose modification time or size
+    has changed since the index was saved, and never parses them.
+    """
+    version = 3 # bump when the format of entries changes
+
+    def __init__(self, songdir="songs", indexfile=None):
+        self.songdir = songdir
+        if indexfile is None:
+            indexfile = default_index(songdir)
+        self.indexfile = indexfile
+        self.entries = {} # filename -> dictionary of file info and metadata
+        self.load()
+
+    def load(self):
+        """Read the index from disk, starting empty if it is missing or stale"""
+        try:
+            with open(self.indexfile, "r") as f:
+                index = json.load(f)
+        except (IOError, OSError, ValueError):
+            return
+        if index.get("version") == self.version and index.get("songdir") == os.path.abspath(self.songdir):
+            self.entries = index["entries"]
+
+    def save(self):
+        """Write the index to disk atomically"""
+        directory = os.path.dirname(os.path.abspath(self.indexfile))
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        index = {"version": self.version,
+                 "songdir": os.path.abspath(self.songdir),
+                 "entries": self.entries}
+        fd, tmpname = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(index, f)
+        os.replace(tmpname, self.indexfile)
+
+    def read_entry(self, filename, stat):
+        """Returns a new index entry for a song file
+
+        A file that cannot be read, such as one that is not UTF-8, gets an
+        entry without any metadata, so it is listed by its filename and
+        read again once it changes.
+        """
+        entry = {"mtime": stat.st_mtime,
+                 "size": stat.st_size,
+                 "hash": None}
+        try:
+            with open(os.path.join(self.songdir, filename), "r") as f:
+                text = f.read()
+        except (OSError, UnicodeError):
+            entry.update(song_metadata(""))
+            return entry
+        entry["hash"] = hashlib.sha1(text.encode("utf-8")).hexdigest()
+        entry.update(song_metadata(text))
+        return entry
+
+    def rescan(self):
+        """Update the index from the song directory, returning the filenames
+
+        Returns the sorted song filenames. The index is saved if any entry
+        was added, changed or removed.
+        """
+        entries = {}
+        changed = False
+        for item in os.scandir(self.songdir):
+            if not is_song_file(item.name) or not item.is_file():
+                continue
+            stat = item.stat()
+            entry = self.entries.get(item.name)
+            if entry is None or entry["mtime"] != stat.st_mtime or entry["size"] != stat.st_size:
+                entry = self.read_entry(item.name, stat)
+                changed = True
+            entries[item.name] = entry
+
+        if changed or len(entries) != len(self.entries):
+            self.entries = entries
+            self.save()
+        return sorted(entries)
+
+    def get(self, filename):
+        """Returns the index entry of a song file, or None"""
+        return self.entries.get(filename)
+
+    def title(self, filename):
+        """Returns the title of a song file, falling back to its filename"""
+        entry = self.entries.get(filename)
+        if entry is None or not entry["title"]:
+            return filename
+        return entry["title"]
+
+    def describe(self, filename, by=True):
+        """Returns the title of a song file with its author, key and capo,
+        see describe"""
+        return describe(filename, self.entries.get(filename), by)
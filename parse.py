@@ -3,212 +3,301 @@
 import re
 import song as s
 
-# applies a single pass of the nano pass compilation process
-def replace_element(song, function):
-    """Apply a function onto each element of a list of lists"""
-    for index, element in enumerate(song):
-        if isinstance(element, list): # if it is a sublist
-            replace_element(element, function)
-        else: # an atomic element
-            song[index] = function(element) # replace its value
-
-# applies a single pass of the nano pass compilation process
-def apply_pass(lst, function, parent=None):
-    """Apply a function onto each element of a list of lists"""
-    for index, element in enumerate(lst):
-        if not isinstance(element, list):
-            # apply function to atomic element
-            function(index, element, lst)
-        else: # another list
-            apply_pass(element, function, parent=lst)
-
-# removes empty lists
-def remove_empty_list(lst):
-    """Remove empty list from song"""
-    for index, element in enumerate(lst):
-        if isinstance(element, list):
-            if len(element) == 0:
-                lst.pop(index)
+# scopes of the nano pass compilation process, telling the pass engine when
+# a pass may run relative to the passes before it
+ELEMENT = 'element' # rewrites one element, as soon as it has been produced
+STANZA = 'stanza'   # looks at the whole stanza, once it has been produced
+SONG = 'song'       # looks at the whole song, once it has been produced
+
+def nanopass(scope, *types):
+    """Declare the scope of a pass and, for element passes, the node types
+    it handles
+
+    Element passes are called with each element of one of the types and
+    return its replacement: a single element, a list of elements or None to
+    remove it. Stanza passes are called with a stanza and song passes with
+    the whole song, and both return the new list.
+    """
+    if scope != ELEMENT and len(types) > 0:
+        raise ValueError("only element passes handle node types")
+    def decorate(function):
+        function.scope = scope
+        function.types = types
+        return function
+    return decorate
+
+
+class Pipeline(object):
+    """Runs passes over a song in as few traversals as possible
+
+    Consecutive element passes are fused so each element is threaded through
+    all of them at once, and a stanza is processed by every pass up to the
+    next song pass before moving on to the next stanza.
+    """
+    def __init__(self, *passes, name=None):
+        self.name = name # reported by the profiler
+        self.passes = passes # in order, for running them one at a time
+        self.segments = []
+        steps = None
+        for function in passes:
+            if function.scope == SONG:
+                self.segments.append(function)
+                steps = None
+                continue
+            if steps is None:
+                steps = []
+                self.segments.append(steps)
+            if function.scope == STANZA or not steps or steps[-1][0] == STANZA:
+                steps.append((function.scope, [function]))
             else:
-                remove_empty_list(element)
-        else:
-            pass
-
-
-# # applies a single pass of the nano pass compilation process
-# def apply_pass(lst, function, parent=None):
-#     """Apply a function onto each element of a list of lists"""
-#     for index, element in enumerate(lst):
-#         if isinstance(element, list): # if it is a sublist
-#             apply_pass(element, function, parent=lst)
-#         else: # an atomic element
-#             function(index, element, lst)
-
-def remove_empty_lines(index, element, parent):
-    if not isinstance(element, str):
-        return
-    if element.isspace() or len(element) == 0:
-        parent.pop(index)
-
-def split_by_colon(index, element, parent):
-    if not isinstance(element, str):
-        return
-    if ':' in element:
-        parent.pop(index)
-        first, second = element.split(':', 1)
-        parent.insert(index, second)
-        parent.insert(index, first)
+                steps[-1][1].append(function)
 
-def trim_whitespace(index, element, parent):
-    if isinstance(element, str):
-        parent[index] = element.strip()
-
-def cleanup_order_command(index, element, parent):
-    if isinstance(element, Command) and element.text == 'order' and len(parent) == 2:
-        order_list = parent[1].split(',')
-        parent.pop(1)
-        order_list.reverse()
-        for item in order_list:
-            parent.insert(1, item.strip())
-
-def cleanup_title_command(index, element, parent):
-    if isinstance(element, Command) and element.text == 'title' and len(parent) == 2:
-        parent[1] = parent[1].strip()
-
-def cleanup_by_command(index, element, parent):
-    if isinstance(element, Command) and element.text == 'by' and len(parent) == 2:
-        parent[1] = parent[1].strip()
-
-def cleanup_comment_command(index, element, parent):
-    if isinstance(element, Command) and element.text == 'comment' and len(parent) == 2:
-        parent[1] = parent[1].strip()
-
-def cleanup_capo_command(index, element, parent):
-    if isinstance(element, Command) and element.text == 'capo' and len(parent) == 2:
-        # make sure capo argument is classified as Text and not Chordline, etc
-        if isinstance(parent[1], str):
-            parent[1] = s.Text(parent[1].strip())
-        else:
-            parent[1] = s.Text(parent[1].text.strip())
+    def run(self, song):
+        """Apply all passes to the song and return the new song"""
+        for segment in self.segments:
+            if isinstance(segment, list):
+                song = [self.run_stanza(stanza, segment) for stanza in song]
+            else:
+                song = segment(song)
+        return song
 
-def merge_chords_lyrics(index, element, parent):
-    if isinstance(element, s.Chordline):
-        # handle dangling chordline at end of stanza
-        if index == len(parent)-1: # if last element of parent
+    def run_stanza(self, stanza, steps):
+        """Apply a segment of stanza and element passes to a stanza"""
+        for scope, functions in steps:
+            if scope == STANZA:
+                stanza = functions[0](stanza)
+                continue
+            result = []
+            for element in stanza:
+                apply_element_passes(element, functions, 0, result)
+            stanza = result
+        return stanza
+
+def apply_element_passes(element, functions, start, result):
+    """Thread an element through the element passes, appending the output"""
+    for position in range(start, len(functions)):
+        function = functions[position]
+        if not isinstance(element, function.types):
+            continue
+        element = function(element)
+        if element is None: # element has been removed
             return
-        elif isinstance(parent[index+1], s.Chordline):
-            # next line is also a chordline
+        if isinstance(element, list): # element has been split up
+            for item in element:
+                apply_element_passes(item, functions, position+1, result)
             return
+    result.append(element)
+
+def remove_elements(stanza, predicate):
+    """Remove matching elements, except one directly following a removed one
+
+    Keeps the output identical to the original in-place passes, which
+    popped elements while iterating and so never examined the element that
+    moved into the removed element's place.
+    """
+    result = []
+    removed = False
+    for element in stanza:
+        if not removed and predicate(element):
+            removed = True
         else:
-            # next line is lyrics
-            chords = parent.pop(index)
-            lyrics = parent.pop(index)
-            combined = s.combine(chords.text, lyrics.text)
-            combined.append('\\\\\n') # keep lines separate
-            combined.reverse()
-            for item in combined:
-                parent.insert(index, item)
-
-    if isinstance(element, s.Text):
-        if index == len(parent) - 1: # last element
-            return
-        elif isinstance(parent[index+1], s.Text) or isinstance(parent[index+1], s.Chordline): # consecutive lyric lines
-            element.text += '\\\\\n'
-
-def handle_multiple_lyrics(index, element, parent):
-    """handle case of multiple lines of lyrics"""
-    if isinstance(element, s.Text):
-        if index == len(parent)-1: # if last element of parent
-            pass
-            #element.text += '\\\\\n'
-        elif isinstance(parent[index+1], s.Text) or isinstance(parent[index+1], s.Chordline):
-            if parent[index+1].text != '\\\\\n' and parent[index].text != '\\\\\n':
-                # next line is also lyrics, therefore keep it a separate line
-                element.text += '\\\\\n'
-        else:
-            pass
-            #element.text# += '\\\\\n'
+            result.append(element)
+            removed = False
+    return result
 
+@nanopass(SONG)
+def remove_empty_stanzas(song):
+    """Remove empty stanzas from song"""
+    return [stanza for stanza in song if len(stanza) > 0]
 
+def is_empty_line(element):
+    return isinstance(element, str) and (element.isspace() or len(element) == 0)
 
-class Command(object):
-    """Represents a command within a song file"""
-    def __init__(self, text):
-        self.text = text.strip()
-        textlist = self.text.split()
-        self.command = textlist[0].lower()
+@nanopass(STANZA)
+def remove_empty_lines(stanza):
+    return remove_elements(stanza, is_empty_line)
 
-        if len(textlist) == 1:
-            self.command_arg = None
+@nanopass(ELEMENT, str)
+def split_by_colon(element):
+    if ':' in element:
+        return element.split(':')
+    return element
+
+@nanopass(ELEMENT, str)
+def trim_whitespace(element):
+    return element.strip()
+
+def is_command(stanza, text):
+    """Check if the stanza is a command with exactly one argument"""
+    return isinstance(stanza[0], s.Command) and stanza[0].text == text and len(stanza) == 2
+
+@nanopass(STANZA)
+def cleanup_order_command(stanza):
+    if is_command(stanza, 'order'):
+        order_list = stanza[1].split(',')
+        return [stanza[0]] + [item.strip() for item in order_list]
+    return stanza
+
+@nanopass(STANZA)
+def cleanup_title_command(stanza):
+    if is_command(stanza, 'title'):
+        return [stanza[0], stanza[1].strip()]
+    return stanza
+
+@nanopass(STANZA)
+def cleanup_by_command(stanza):
+    if is_command(stanza, 'by'):
+        return [stanza[0], stanza[1].strip()]
+    return stanza
+
+@nanopass(STANZA)
+def cleanup_comment_command(stanza):
+    if is_command(stanza, 'comment'):
+        return [stanza[0], stanza[1].strip()]
+    return stanza
+
+@nanopass(STANZA)
+def cleanup_capo_command(stanza):
+    if is_command(stanza, 'capo'):
+        # make sure capo argument is classified as Text and not Chordline, etc
+        if isinstance(stanza[1], str):
+            return [stanza[0], s.Text(stanza[1].strip())]
         else:
-            self.command_arg = textlist[1]
-
-    def __repr__(self):
-        return "Command({})".format(self.text)
-
-
-def identify_commands(index, element, parent):
-    if isinstance(element, str) and index == 0:
-        parent.pop(index)
-        parent.insert(index, Command(element))
-
-def identify_chordlines(index, element, parent):
-    if isinstance(element, str):
-        if s.is_chord_line(element):
-            parent.pop(index)
-            parent.insert(index, s.Chordline(element))
-
-def identify_text(index, element, parent):
-    if isinstance(element, str):
-        if not s.is_chord_line(element):
-            parent.pop(index)
-            parent.insert(index, s.Text(element))
+            return [stanza[0], s.Text(stanza[1].text.strip())]
+    return stanza
+
+def combine_chord_lines(elements):
+    """Combine each song.Chordline with the lyrics directly below it into
+    one song.Lyricline, returning the new list
+
+    A Chordline followed by another Chordline, or by nothing, is kept.
+    Shared by chordsheets and previews, so both pair lines the same way.
+    """
+    combined = []
+    index = 0
+    last = len(elements) - 1
+    while index <= last:
+        element = elements[index]
+        # handle dangling chordline at end of stanza, or next line is
+        # also a chordline
+        if (isinstance(element, s.Chordline) and index < last
+                and not isinstance(elements[index+1], s.Chordline)):
+            # next line is lyrics
+            combined.append(s.combine_line(element.text, elements[index+1].text,
+                                           element.chords))
+            index += 2
+            continue
+        combined.append(element)
+        index += 1
+    return combined
+
+@nanopass(STANZA)
+def merge_chords_lyrics(stanza):
+    lines = combine_chord_lines(stanza)
+    merged = []
+    for index, element in enumerate(lines):
+        if isinstance(element, s.Lyricline):
+            merged.append(element)
+            merged.append('\\\\\n') # keep lines separate
+            continue
+
+        if isinstance(element, s.Text) and index < len(lines)-1:
+            # consecutive lyric lines
+            if isinstance(lines[index+1], (s.Text, s.Chordline, s.Lyricline)):
+                element = s.Text(element.text + '\\\\\n')
+
+        merged.append(element)
+    return merged
+
+@nanopass(STANZA)
+def handle_multiple_lyrics(stanza):
+    """handle case of multiple lines of lyrics"""
+    handled = []
+    for index, element in enumerate(stanza):
+        if isinstance(element, s.Text) and index < len(stanza)-1:
+            following = stanza[index+1]
+            if isinstance(following, s.Lyricline):
+                # lyrics before its first chord count as a line of lyrics
+                lead = following.lead()
+                following = s.Text(lead) if len(lead) > 0 else None
+            if isinstance(following, (s.Text, s.Chordline)):
+                if following.text != '\\\\\n' and element.text != '\\\\\n':
+                    # next line is also lyrics, therefore keep it a separate line
+                    element = s.Text(element.text + '\\\\\n')
+        handled.append(element)
+    return handled
+
+
+@nanopass(STANZA)
+def identify_commands(stanza):
+    if isinstance(stanza[0], str):
+        return [s.Command(stanza[0])] + stanza[1:]
+    return stanza
+
+@nanopass(ELEMENT, str)
+def identify_lines(element):
+    """Lex a line into a song.Chordline or song.Text"""
+    kind, chords = s.lex_line(element)
+    if kind == s.CHORDS:
+        return s.Chordline(element, chords)
+    if kind == s.BLANK: # blank lines that are left count as chord lines
+        return s.Chordline(element, ())
+    return s.Text(element)
+
+@nanopass(ELEMENT, str)
+def identify_text(element):
+    # the lines were lexed by the front end, but the chords pipeline makes
+    # new strings, the joined order and the line breaks of merged lines,
+    # which later passes need to see as Text
+    if not s.is_chord_line(element):
+        return s.Text(element)
+    return element
 
 def parse_structure(lines):
     """Break up song text into list of lists"""
-    lines.reverse() # easier to group stanzas in reverse
-    stack = []
     songlist = []
+    stanza = None
     for item in lines:
-        if ':' in item:
-            stack.append(item)
-            stack.reverse()
-            songlist.append(stack)
-            stack = []
-        else:
-            stack.append(item)
-    songlist.reverse()
-    lines.reverse()
+        if ':' in item: # a command starts a new stanza
+            stanza = [item]
+            songlist.append(stanza)
+        elif stanza is not None: # text before the first command is ignored
+            stanza.append(item)
     return songlist
 
-def print_item(index, element, parent):
+@nanopass(ELEMENT, object)
+def print_item(element):
     if isinstance(element, str):
         print(element)
     else:
         print(element.text)
+    return element
 
 # handle chords order command
-def handle_chords_order(index, element, parent):
-    if isinstance(element, Command) and element.text == 'order':
-        args = []
-        for i in range(len(parent[1:])):
-            args.append(parent.pop(1).text)
-        parent.append(', '.join(args))
+@nanopass(STANZA)
+def handle_chords_order(stanza):
+    if isinstance(stanza[0], s.Command) and stanza[0].text == 'order':
+        args = [element.text for element in stanza[1:]]
+        return [stanza[0], ', '.join(args)]
+    return stanza
+
 
+# commands that start a stanza of lyrics
+stanza_commands = ["verse", "chorus", "prechorus", "bridge", "intro", "outro", "tag", "break", "interlude"]
 
+@nanopass(SONG)
 def handle_slides_order(song):
-    stanzas = ["verse", "chorus", "prechorus", "bridge", "intro", "outro", "tag", "break", "interlude", "order"]
+    stanzas = stanza_commands + ["order"]
     stanzadict = {}
     newsong = []
 
-    def collect(index, element, parent):
-        if isinstance(element, Command):
+    for stanza in song:
+        element = stanza[0]
+        if isinstance(element, s.Command):
             if element.command in stanzas:
-                stanzadict[element.text] = parent
+                stanzadict[element.text] = stanza
             else:
-                newsong.append(parent)
-
-    apply_pass(song, collect)
+                newsong.append(stanza)
 
     if "order" in stanzadict:
         order = stanzadict["order"]
@@ -231,12 +320,10 @@ def expand_order(order):
             expanded.append(item)
         else:
             i = item.index('x')
-            if i >= len(item)-1:
-                raise ValueError("Malformed order entry: {}".format(item))
             if item[i-1].isdigit():
                 n = int(item[i-1])
                 stanza = item[:i-1].strip()
-            elif item[i+1].isdigit():
+            elif i < len(item)-1 and item[i+1].isdigit():
                 n = int(item[i+1])
                 stanza = item[:i].strip()
             else:
@@ -251,53 +338,95 @@ def latex_command(command, arg):
     """Returns a latex command with a single argument"""
     return "\{}{{{}}}".format(command, arg)
 
-def chord_to_latex(index, element, parent):
-    """Returns latex command for Chord class"""
-    if isinstance(element, s.Chord):
-        chord = element.text.replace('#', '\#') # latex requires backslash
-        chord = chord.replace('b', '$\\flat$') # change to latex's flat symbol
-        parent[index] = latex_command("chord", chord)
+def chord_latex(chord):
+    """Returns the latex command for a chord name"""
+    chord = chord.replace('#', '\#') # latex requires backslash
+    chord = chord.replace('b', '$\\flat$') # change to latex's flat symbol
+    return latex_command("chord", chord)
 
-def chordline_to_latex(index, element, parent):
+@nanopass(ELEMENT, s.Chord)
+def chord_to_latex(element):
+    """Returns latex command for Chord class"""
+    return chord_latex(element.text)
+
+# chord id -> latex command, see song.intern_chord
+chord_latex_commands = {}
+
+@nanopass(ELEMENT, s.Lyricline)
+def lyricline_to_latex(element):
+    """Returns latex for the song.Lyricline class, a chord command before
+    each chord's piece of the lyrics"""
+    latex = []
+    lead = element.lead()
+    if len(lead) > 0:
+        latex.append(lyrics_to_latex(lead))
+    for id, text in zip(element.ids, element.pieces()):
+        chord = chord_latex_commands.get(id)
+        if chord is None:
+            chord = chord_latex_commands[id] = chord_latex(s.chord_names[id])
+        latex.append(chord)
+        latex.append(lyrics_to_latex(text))
+    if len(latex) == 0:
+        return None
+    line = ''.join(latex)
+    if "{}" in line:
+        # remove_empty_latex_commands removes pieces on their own
+        return latex
+    return line
+
+@nanopass(ELEMENT, s.Chordline)
+def chordline_to_latex(element):
     """Returns latex command for the song.Chordline class"""
-    if isinstance(element, s.Chordline):
-        chords = element.text.replace('#', '\#') # latex requires backslash
-        chords = chords.replace('b', '$\\flat$') # change to latex's flat symbol
-        parent[index] = latex_command("chordline", chords)
+    chords = element.text.replace('#', '\#') # latex requires backslash
+    chords = chords.replace('b', '$\\flat$') # change to latex's flat symbol
+    return latex_command("chordline", chords)
 
-def text_to_latex(index, element, parent):
+@nanopass(ELEMENT, s.Text)
+def text_to_latex(element):
     """Returns latex command for Text class"""
-    if isinstance(element, s.Text):
-        parent[index] = element.text + '\\\\'
+    return element.text + '\\\\'
 
 parenthesis_regex = re.compile("\((.+)\)")
 
-def parenthesis_to_latex(index, element, parent):
+def emphasize_parenthesis(text):
+    """Returns the text with any text in parentheses emphasized"""
+    match = re.search(parenthesis_regex, text)
+    if match is not None:
+        oldtext = match.group()
+        newtext = latex_command("emph", "({})".format(oldtext[1:-1]))
+        return text.replace(oldtext, newtext)
+    return text
+
+def lyrics_to_latex(text):
+    """Returns latex for a piece of lyrics in a chordsheet"""
+    text = emphasize_parenthesis(text)
+    return text.replace("   ", latex_command("hspace", "3mm"))
+
+@nanopass(ELEMENT, s.Text)
+def parenthesis_to_latex(element):
     """Handle emphasized text surrounded by parentheses"""
-    if isinstance(element, s.Text):
-        match = re.search(parenthesis_regex, element.text)
-        if match is not None:
-            oldtext = match.group()
-            newtext = latex_command("emph", "({})".format(oldtext[1:-1]))
-            element.text = element.text.replace(oldtext, newtext)
-
-def remove_parenthesis(index, element, parent):
+    text = emphasize_parenthesis(element.text)
+    if text is not element.text:
+        return s.Text(text)
+    return element
+
+@nanopass(ELEMENT, s.Text)
+def remove_parenthesis(element):
     """Remove any words surrounded by parenthesis"""
-    if isinstance(element, s.Text):
-        match = re.search(parenthesis_regex, element.text)
-        if match is not None:
-            parent.pop(index)
+    match = re.search(parenthesis_regex, element.text)
+    if match is None:
+        return element
 
 
-def spacing_to_latex(index, element, parent):
+@nanopass(ELEMENT, s.Text)
+def spacing_to_latex(element):
     """Produce latex code to handle explicit spacing between words"""
-    if isinstance(element, s.Text):
-        parent[index] = element.text.replace("   ", latex_command("hspace", "3mm"))
+    return element.text.replace("   ", latex_command("hspace", "3mm"))
 
-def ampersand_to_latex(index, element, parent):
+@nanopass(ELEMENT, s.Text)
+def ampersand_to_latex(element):
     """Replace ampersand symbol with latex one"""
-    if isinstance(element, s.Text):
-        parent[index] = element.text.replace('&', '\&')
+    return element.text.replace('&', '\&')
 
 # maps song file commands to their equivalent latex command
 command_map = {"title": "songtitle",
@@ -317,66 +446,64 @@ command_map = {"title": "songtitle",
                "interlude": "interlude",
                "format": "songformat"}
 
-def check_command_validity(index, element, parent):
+@nanopass(ELEMENT, s.Command)
+def check_command_validity(element):
     """Check that commands are valid song file ones"""
-    if isinstance(element, Command):
-        if not element.command in command_map.keys():
-            raise RuntimeError("Command not valid: {}".format(element.command))
-
-def command_to_latex(index, element, parent):
+    if not element.command in command_map.keys():
+        raise RuntimeError("Command not valid: {}".format(element.command))
+    return element
+
+def latex_command_name(element):
+    """Returns the latex command name, including any argument, for a song.Command"""
+    command = command_map[element.command]
+    if element.command_arg != None:
+        command = command + "[~" + element.command_arg + "]"
+    return command
+
+@nanopass(STANZA)
+def command_to_latex(stanza):
     """Produce latex code for the commands and their arguments"""
-    if isinstance(element, Command):
-        command = command_map[element.command]
-        if element.command_arg != None:
-            command = command + "[~" + element.command_arg + "]"
-
-        #print(command)
+    if isinstance(stanza[0], s.Command):
+        command = latex_command_name(stanza[0])
+        return [latex_command(command, ''.join(stanza[1:]))]
+    return stanza
 
-        args = parent[1:]
-        for i in range(len(args)):
-            parent.pop(-1)
-        parent[index] = latex_command(command, ''.join(args))
-
-def slides_command_to_latex(index, element, parent):
+@nanopass(STANZA)
+def slides_command_to_latex(stanza):
     """Produce latex code for the slides commands and their arguments"""
-    if isinstance(element, Command):
-        command = command_map[element.command]
-        if element.command_arg != None:
-            command = command + "[~" + element.command_arg + "]"
-
-        #print(command)
+    if isinstance(stanza[0], s.Command):
+        command = latex_command_name(stanza[0])
+        return [latex_command(command, '\\\\\n'.join(stanza[1:]))]
+    return stanza
 
-        args = parent[1:]
-        for i in range(len(args)):
-            parent.pop(-1)
-        parent[index] = latex_command(command, '\\\\\n'.join(args))
 
 
-
-def remove_chords(index, element, parent):
+@nanopass(ELEMENT, s.Chordline, s.Chord)
+def remove_chords(element):
     """Remove chords from song"""
-    if isinstance(element, s.Chordline) or isinstance(element, s.Chord):
-        parent.pop(index)
+    return None
 
-def remove_capo(index, element, parent):
+@nanopass(STANZA)
+def remove_capo(stanza):
     """Remove capo command from song"""
-    if isinstance(element, Command) and element.text == 'capo':
-        #parent.clear() # python 3 only
-        del parent[:]
+    if isinstance(stanza[0], s.Command) and stanza[0].text == 'capo':
+        return []
+    return stanza
 
-def remove_order(index, element, parent):
+@nanopass(STANZA)
+def remove_order(stanza):
     """Removes the order command"""
-    if isinstance(element, Command) and element.text == 'order':
-        #for i in range(len(parent)):
-        #    parent.pop(-1)
-        del parent[:] # clear contents of parent list
-        #parent.clear() # python 3 only
+    if isinstance(stanza[0], s.Command) and stanza[0].text == 'order':
+        return []
+    return stanza
+
+def is_empty_latex_command(element):
+    return isinstance(element, str) and "{}" in element
 
-def remove_empty_latex_commands(index, element, parent):
+@nanopass(STANZA)
+def remove_empty_latex_commands(stanza):
     """Removes empty latex commands"""
-    if isinstance(element, str):
-        if "{}" in element:
-            parent.pop(index)
+    return remove_elements(stanza, is_empty_latex_command)
 
 def elements_to_string(songlist):
     """Combine all elements into a string separated by newlines"""
@@ -390,110 +517,208 @@ def page_breaks(song):
 def column_breaks(song):
     return song + '\n\columnbreak\n'
 
-def compile_chords(filename):
-    """Converts a song file into latex code for a chordsheet"""
-    with open(filename, 'r') as f:
-        lines = f.read().split('\n')
-    song = parse_structure(lines)
-
-    # clean up and find commands
-    apply_pass(song, split_by_colon)
-    apply_pass(song, remove_empty_lines)
-    apply_pass(song, identify_commands)
-    apply_pass(song, check_command_validity)
-
-    # clean up command arguments
-    apply_pass(song, cleanup_title_command)
-    apply_pass(song, cleanup_by_command)
-    apply_pass(song, cleanup_title_command)
-    apply_pass(song, cleanup_order_command)
-    apply_pass(song, cleanup_comment_command)
-    apply_pass(song, cleanup_capo_command)
-
+# optional profiler.Profiler recording every pass, see set_profiler
+profiler = None
+
+def set_profiler(new_profiler):
+    """Record the passes of every song parsed or rendered with a
+    profiler.Profiler, or stop recording them if it is None"""
+    global profiler
+    profiler = new_profiler
+
+def run_pipeline(pipeline, stanzas, filename):
+    """Run a pipeline over a song's stanzas, with the profiler if set"""
+    if profiler is not None:
+        return profiler.run(pipeline, stanzas, filename)
+    return pipeline.run(stanzas)
+
+# front end shared by chordsheets and slides, which cleans up the song file,
+# finds its commands and classifies its lines
+front_end_pipeline = Pipeline(
+    split_by_colon,
+    remove_empty_lines,
+    identify_commands,
+    check_command_validity,
+    cleanup_title_command,
+    cleanup_by_command,
+    cleanup_order_command,
+    cleanup_comment_command,
+    cleanup_capo_command,
+    identify_lines,
+    name="front_end")
+
+chords_pipeline = Pipeline(
     # process chords and lyrics
-    apply_pass(song, identify_chordlines)
-    apply_pass(song, identify_text)
-    apply_pass(song, handle_chords_order)
-    remove_empty_list(song)
-    apply_pass(song, merge_chords_lyrics)
-    
-    apply_pass(song, identify_text)
-    apply_pass(song, handle_multiple_lyrics)
-    apply_pass(song, identify_text)
-    
+    handle_chords_order,
+    merge_chords_lyrics,
+    identify_text,
+    handle_multiple_lyrics,
+
     # latex generation
-    apply_pass(song, chord_to_latex)
-    apply_pass(song, chordline_to_latex)
-    apply_pass(song, parenthesis_to_latex)
-    apply_pass(song, spacing_to_latex)
-    apply_pass(song, ampersand_to_latex)
-    apply_pass(song, remove_empty_latex_commands)
-    apply_pass(song, command_to_latex)
+    lyricline_to_latex,
+    chordline_to_latex,
+    parenthesis_to_latex,
+    spacing_to_latex,
+    ampersand_to_latex,
+    remove_empty_latex_commands,
+    command_to_latex,
+
+    # final clean up of empty lists
+    remove_empty_stanzas,
+    name="chords")
+
+slides_pipeline = Pipeline(
+    # process chords and lyrics
+    remove_chords,
+    remove_capo,
+    remove_empty_stanzas,
 
+    # handle order
+    handle_slides_order,
+
+    # latex generation
+    ampersand_to_latex,
+    slides_command_to_latex,
 
     # final clean up of empty lists
-    remove_empty_list(song)
+    remove_empty_latex_commands,
+    remove_empty_stanzas,
+    name="slides")
+
+def read_song(filename, text=None):
+    """Read a song file, unless its text is given, and break it into stanzas"""
+    if text is None:
+        with open(filename, 'r') as f:
+            text = f.read()
+    return parse_structure(text.split('\n'))
+
+def parse_song(filename, text=None):
+    """Parse a song file into a song.Song shared by all renderers
+
+    text is the contents of the file, if it has already been read.
+    """
+    stanzas = run_pipeline(front_end_pipeline, read_song(filename, text), filename)
+    return s.Song(filename, stanzas)
+
+# commands found in the header of a song file, before its first stanza
+header_commands = ["title", "by", "capo", "comment", "order"]
+
+def scan_header(lines):
+    """Read the header of a song file without parsing the whole song
+
+    lines may be an open file, which is only read up to the first stanza
+    command and on to the first line of chords in that stanza, whose first
+    chord is taken as the song's key. Returns a dict of the header commands
+    found and their arguments, the order as a list of stanza names, and
+    "key", which is None if the first stanza has no chords.
+    """
+    header = {"key": None}
+    command = None
+    for line in lines:
+        line = line.rstrip("\r\n")
+        kind, chords = s.lex_line(line)
+        if kind == s.HEADER:
+            if command in stanza_commands: # end of the first stanza
+                break
+            name, arg = line.split(':', 1)
+            command = name.split()[0].lower() if name.strip() else None
+            if command in header_commands:
+                header[command] = arg.strip()
+        elif command in stanza_commands:
+            if kind == s.CHORDS and len(chords) > 0:
+                header["key"] = chords[0][1]
+                break
+        elif command in header and kind != s.BLANK: # argument goes on
+            header[command] = (header[command] + ' ' + line.strip()).strip()
+    if "order" in header:
+        header["order"] = [item.strip() for item in header["order"].split(',')
+                           if item.strip()]
+    return header
+
+def check_song(filename, text=None):
+    """Check a song file for the errors that would stop it from compiling
+
+    Runs the front end on each stanza separately and checks the order
+    entries against the stanzas, so every error is found in one go. Returns
+    a list of (line number, message), where the line number is None for
+    errors that belong to the whole file.
+    """
+    if text is None:
+        with open(filename, 'r') as f:
+            text = f.read()
+    lines = text.split('\n')
+    # every line with a colon starts a stanza
+    headers = [num for num, line in enumerate(lines, 1) if ':' in line]
+
+    errors = []
+    stanzas = []
+    numbers = [] # line number of each stanza in stanzas
+    for num, stanza in zip(headers, parse_structure(lines)):
+        if len(stanza[0].split(':')[0].strip()) == 0:
+            errors.append((num, "Missing command before colon"))
+            continue
+        try:
+            stanzas.extend(front_end_pipeline.run([stanza]))
+        except Exception as err:
+            errors.append((num, str(err)))
+            continue
+        numbers.append(num)
+
+    names = set(stanza[0].text for stanza in stanzas
+                if stanza[0].command in stanza_commands)
+    for num, stanza in zip(numbers, stanzas):
+        if stanza[0].command != 'order':
+            continue
+        # slides remove chordlines before the order is used
+        entries = [item.text for item in stanza[1:] if isinstance(item, s.Text)]
+        try:
+            order = expand_order(entries)
+        except ValueError as err:
+            errors.append((num, str(err)))
+            continue
+        missing = [name for name in order if name not in names]
+        for name in sorted(set(missing), key=missing.index): # once each
+            errors.append((num, "Order entry is not a stanza: {}".format(name)))
+
+    if len(errors) == 0: # anything else a build would run into
+        song = s.Song(filename, stanzas)
+        for mode in sorted(renderers):
+            try:
+                renderers[mode](song)
+            except Exception as err:
+                errors.append((None, "Cannot render {}: {}".format(mode, err)))
+    errors.sort(key=lambda error: error[0] or 0)
+    return errors
+
+def render_chords(song):
+    """Returns latex code for a chordsheet from a parsed song"""
+    stanzas = run_pipeline(chords_pipeline, song.stanza_lists(), song.filename)
 
     # combine all elements into a single string
-    song = elements_to_string(song)
-    song = song.replace('\\\\\n\\\\\n', '\\\\\n') # remove double newlines
+    text = elements_to_string(stanzas)
+    text = text.replace('\\\\\n\\\\\n', '\\\\\n') # remove double newlines
 
-    return song
+    return text
 
+def render_slides(song):
+    """Returns latex code for presentation slides from a parsed song"""
+    stanzas = run_pipeline(slides_pipeline, song.stanza_lists(), song.filename)
 
-def compile_slides(filename):
-    """Converts a song file into latex code for presentation slides"""
-    with open(filename, 'r') as f:
-        lines = f.read().split('\n')
-    song = parse_structure(lines)
-
-    # clean up and find commands
-    apply_pass(song, split_by_colon)
-    apply_pass(song, remove_empty_lines)
-    apply_pass(song, identify_commands)
-    apply_pass(song, check_command_validity)
-
-    # clean up command arguments
-    apply_pass(song, cleanup_title_command)
-    apply_pass(song, cleanup_by_command)
-    apply_pass(song, cleanup_title_command)
-    apply_pass(song, cleanup_order_command)
-    apply_pass(song, cleanup_comment_command)
-    apply_pass(song, cleanup_capo_command)
+    # combine all elements into a single string
+    return elements_to_string(stanzas)
 
-    # process chords and lyrics
-    apply_pass(song, identify_chordlines)
-    apply_pass(song, remove_chords)
-    apply_pass(song, remove_chords)
-    apply_pass(song, remove_chords)
-    apply_pass(song, remove_chords)
-    apply_pass(song, remove_chords)
-    apply_pass(song, remove_capo)
-
-    apply_pass(song, identify_text)
-
-    remove_empty_list(song)
-    
-    # handle order
-    song = handle_slides_order(song)
+# renders a parsed song for each output mode
+renderers = {"chords": render_chords,
+             "slides": render_slides}
 
-    # latex generation
-    apply_pass(song, ampersand_to_latex)
-    apply_pass(song, slides_command_to_latex)
+def compile_chords(filename):
+    """Converts a song file into latex code for a chordsheet"""
+    return render_chords(parse_song(filename))
 
-    # final clean up of empty lists
-    remove_empty_list(song)
-    apply_pass(song, remove_empty_latex_commands)
-    remove_empty_list(song)
-    remove_empty_list(song)
-    remove_empty_list(song)
-    remove_empty_list(song)
-    remove_empty_list(song)
-
-    # # combine all elements into a single string
-    song = elements_to_string(song)
-
-    return song
+
+def compile_slides(filename):
+    """Converts a song file into latex code for presentation slides"""
+    return render_slides(parse_song(filename))
 
 if __name__ == '__main__':
     songname = 'songs/WhomShallIFear.txt'
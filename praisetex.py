@@ -3,51 +3,286 @@ sheets"""
 
 import sys
 import os
+import time
 from collections import deque
 import argparse
 
 import core
-import gui
+import parse
+import cache
+import texformat
+import library
+import transpose
+import client
 
 # get praisetex folders's absolute path
 praisetex_dir = os.path.dirname(os.path.abspath(__file__))
 
 def runGUI():
+    import gui # only load tkinter when the window is shown
     app = gui.PraiseTexGUI(os.path.join(praisetex_dir, "songs"))
     app.run()
 
 
-def chords(filename):
-    if len(filename) > 0:
-        print("Creating chords from: {}".format(args.filename))
-        songList = [os.path.basename(f) for f in filename]
-        praisetex = core.PraiseTex()
-        praisetex.refreshSongList()
-        index = 0
-        for songtitle in songList:
-            praisetex.addSong(index, songtitle)
-            index += 1
-        error = praisetex.compileChords()
-        if error:
-            print("pdflatex has failed")
-        else:
-            print("Compiled chords.pdf")
-
-def slides(filename):
-    if len(filename) > 0:
-        print("Creating slides from: {}".format(args.filename))
-        songList = [os.path.basename(f) for f in filename]
-        praisetex = core.PraiseTex()
-        praisetex.refreshSongList()
-        index = 0
-        for songtitle in songList:
-            praisetex.addSong(index, songtitle)
-            index += 1
-        error = praisetex.compileSlides()
-        if error:
-            print("pdflatex has failed")
+def getCache(args):
+    if args.no_cache:
+        return None
+    return cache.FragmentCache()
+
+def getPdfCache(args):
+    if not args.per_song:
+        return None
+    if core.PdfWriter is None:
+        print("Joining per-song PDFs requires pypdf, compiling whole documents instead")
+        return None
+    return cache.PdfCache()
+
+def getFormats(args):
+    if args.no_format:
+        return None
+    return texformat.FormatCache()
+
+def createPraiseTex(filename):
+    """Create a PraiseTex with the song files added to its compile list"""
+    songList = [os.path.basename(f) for f in filename]
+    praisetex = core.PraiseTex(cache=getCache(args), workers=args.jobs,
+                               formats=getFormats(args),
+                               pdfcache=getPdfCache(args))
+    praisetex.pipe = args.pipe
+    praisetex.templateDirs = args.templates + praisetex.templateDirs
+    if args.profile or args.profile_json is not None:
+        import profiler
+        praisetex.profiler = profiler.Profiler()
+        parse.set_profiler(praisetex.profiler)
+    if args.transpose is not None:
+        praisetex.transposer = transpose.Transposer(args.transpose, not args.flats)
+    praisetex.refreshSongList()
+    index = 0
+    for songtitle in songList:
+        praisetex.addSong(index, songtitle)
+        index += 1
+    return praisetex
+
+def chords(praisetex):
+    """Compile the chords, returning True if pdflatex succeeded"""
+    print("Creating chords from: {}".format(args.filename))
+    error = praisetex.compileChords(args.chords_output)
+    if error:
+        print("pdflatex has failed")
+    else:
+        print("Compiled {}".format(args.chords_output))
+    return not error
+
+def slides(praisetex):
+    """Compile the slides, returning True if pdflatex succeeded"""
+    print("Creating slides from: {}".format(args.filename))
+    error = praisetex.compileSlides(args.slides_output)
+    if error:
+        print("pdflatex has failed")
+    else:
+        print("Compiled {}".format(args.slides_output))
+    return not error
+
+def reportProfile(praisetex):
+    """Print and/or save where the time of the build went"""
+    if praisetex.profiler is None:
+        return
+    if args.profile:
+        print(praisetex.profiler.table())
+    if args.profile_json is not None:
+        praisetex.profiler.save(args.profile_json)
+
+def getOutputs(modes):
+    """Map each of the modes to its output filename"""
+    return dict((mode, getattr(args, mode + "_output")) for mode in modes)
+
+def checkOutputs(modes):
+    """Check that the outputs of the modes can be written, printing why not
+    and returning False if one cannot"""
+    for mode, output in sorted(getOutputs(modes).items()):
+        directory = os.path.dirname(os.path.abspath(output))
+        if not os.path.isdir(directory):
+            print("Cannot create {}: no directory {}".format(output, directory))
+            return False
+        if not os.access(directory, os.W_OK):
+            print("Cannot create {}: directory {} is not writable".format(output, directory))
+            return False
+    return True
+
+def reportBuild(mode, error, seconds):
+    output = getattr(args, mode + "_output")
+    if error:
+        log = os.path.splitext(output)[0] + ".log"
+        print("pdflatex has failed for {} after {:.1f}s, see {}".format(mode, seconds, log))
+    else:
+        print("Compiled {} in {:.1f}s".format(output, seconds))
+
+def chordsAndSlides(praisetex):
+    """Compile the chords and slides at once, returning True if both succeeded"""
+    print("Creating chords and slides from: {}".format(args.filename))
+    results = praisetex.compileOutputs(getOutputs(["chords", "slides"]), report=reportBuild)
+    return not any(error for error, seconds in results.values())
+
+def serverBuild(modes):
+    """Build the outputs with a running build server instead of here"""
+    songs = [os.path.basename(f) for f in args.filename]
+    for mode in modes:
+        output = getattr(args, mode + "_output")
+        print("Creating {} from: {}".format(mode, args.filename))
+        start = time.time()
+        client.build(args.server, songs, mode, output, args.transpose, args.flats)
+        print("Compiled {} in {:.1f}s".format(output, time.time() - start))
+
+def batchBuild(manifest):
+    """Compile every set list of a manifest, returning True if all succeeded"""
+    import batch
+    try:
+        setlists = batch.load_manifest(manifest)
+    except batch.ManifestError as err:
+        print(err)
+        return False
+    failed = []
+    def report(name, mode, output, error, seconds):
+        if isinstance(error, str): # a song file is broken
+            print("{} {}: {}".format(name, mode, error))
+            failed.append(output)
+        elif error:
+            log = os.path.splitext(output)[0] + ".log"
+            print("pdflatex has failed for {} {} after {:.1f}s, see {}".format(name, mode, seconds, log))
+            failed.append(output)
         else:
-            print("Compiled slides.pdf")
+            print("Compiled {} in {:.1f}s".format(output, seconds))
+    start = time.time()
+    results = batch.run_batch(setlists, cache=getCache(args), formats=getFormats(args),
+                              workers=args.jobs, pdfcache=getPdfCache(args),
+                              pipe=args.pipe, jobs=args.pdflatex_jobs, report=report,
+                              templatedirs=args.templates)
+    print("Compiled {} of {} outputs of {} set lists in {:.1f}s".format(
+        len(results) - len(failed), len(results), len(setlists), time.time() - start))
+    return len(failed) == 0
+
+def watchOutputs(praisetex, modes):
+    """Rebuild the outputs whenever their song files or templates change
+
+    Songs are compiled again after every change, reusing the results for
+    unchanged song files, and only outputs whose song texts or template
+    changed are run through pdflatex.
+    """
+    outputs = getOutputs(modes)
+    paths = set(os.path.join(praisetex.getSongDirectory(), song)
+                for song in praisetex.compile)
+    paths.update(praisetex.templatePath(mode) for mode in outputs)
+    import watch
+    watcher = watch.watcher(paths)
+    built = {} # mode -> song texts of its last successful build
+    changed = set()
+    try:
+        while True:
+            songtexts = {}
+            for mode in outputs:
+                try:
+                    songtexts[mode] = list(praisetex.songTexts(mode))
+                except core.CompileError as err: # try again after the next change
+                    print(err)
+            stale = dict((mode, outputs[mode]) for mode in songtexts
+                         if praisetex.templatePath(mode) in changed
+                         or songtexts[mode] != built.get(mode))
+            if len(stale) > 0:
+                results = praisetex.compileOutputs(stale, report=reportBuild,
+                                                   songtexts=songtexts)
+                for mode, (error, seconds) in results.items():
+                    if not error:
+                        built[mode] = songtexts[mode]
+            elif len(songtexts) > 0:
+                print("Outputs are up to date")
+
+            print("Watching {} files for changes, press Ctrl-C to stop".format(len(paths)))
+            changed = watcher.wait()
+            print("Changed: {}".format(", ".join(sorted(changed))))
+    except KeyboardInterrupt:
+        print("Stopped watching")
+    finally:
+        watcher.close()
+
+def searchSongs(query):
+    import search
+    songlibrary = library.SongLibrary("songs")
+    songlibrary.rescan()
+    index = search.SearchIndex(songlibrary)
+    index.refresh()
+    for filename, line in index.search(query):
+        print("{}: {}".format(filename, songlibrary.title(filename)))
+        if line is not None:
+            print("    {}".format(line))
+
+def listSongs(filenames):
+    """Print the title, author, key and capo of the song files, or of all
+    songs if none given
+
+    Only the headers of the given song files are read. Without any, only
+    new or changed song files are read, through the song library's index.
+    """
+    if len(filenames) > 0:
+        entries = [(filename, library.read_header(filename)) for filename in filenames]
+    else:
+        songlibrary = library.SongLibrary("songs")
+        entries = [(filename, songlibrary.get(filename))
+                   for filename in songlibrary.rescan()]
+    for filename, entry in entries:
+        print("{}: {}".format(filename, library.describe(filename, entry)))
+
+def checkSongs(filenames):
+    """Report every error in the song files, or in all songs if none given"""
+    praisetex = core.PraiseTex(workers=args.jobs)
+    if len(filenames) == 0:
+        filenames = [os.path.join(praisetex.getSongDirectory(), song)
+                     for song in praisetex.refreshSongList()]
+    failed = 0
+    count = 0
+    for filename, errors in praisetex.checkSongs(filenames):
+        if len(errors) > 0:
+            failed += 1
+        for line, message in errors:
+            count += 1
+            if line is None:
+                print("{}: {}".format(filename, message))
+            else:
+                print("{}:{}: {}".format(filename, line, message))
+    print("{} errors in {} of {} song files".format(count, failed, len(filenames)))
+    return failed == 0
+
+def previewSongs(filenames, format):
+    """Print a preview of the song files as text or an HTML document,
+    without running latex
+
+    A filename of - reads a song from standard input, such as an editor's
+    unsaved buffer.
+    """
+    import preview
+    transposer = None
+    if args.transpose is not None:
+        transposer = transpose.Transposer(args.transpose, not args.flats)
+    previews = []
+    failed = False
+    for filename in filenames:
+        text = sys.stdin.read() if filename == "-" else None
+        try:
+            previews.append(preview.preview_file(filename, format, text, transposer))
+        except Exception as err: # keep previewing the other songs
+            print("{}: {}".format(filename, err), file=sys.stderr)
+            failed = True
+    if format == "html":
+        sys.stdout.write(preview.html_document(previews))
+    else:
+        sys.stdout.write('\n'.join(previews))
+    return not failed
+
+def transposeSongs(filenames, halfsteps):
+    """Print the song files with their chords transposed"""
+    transposer = transpose.Transposer(halfsteps, not args.flats)
+    for filename in filenames:
+        with open(filename) as f:
+            sys.stdout.write(transposer.text(f.read()))
 
 def getParser():
     parser = argparse.ArgumentParser(description='praiseTex: program for creating guitar chordsheets and presentation slides.')
@@ -58,10 +293,58 @@ def getParser():
                         help='create chord sheets from provided song files')
     parser.add_argument('-s', '--slides', action='store_true', default=False, 
                         help='create presentation slides from provided song files')
+    parser.add_argument('--chords-output', action='store', default='chords.pdf', metavar='FILE',
+                        help='filename of the chord sheets (default: chords.pdf)')
+    parser.add_argument('--slides-output', action='store', default='slides.pdf', metavar='FILE',
+                        help='filename of the presentation slides (default: slides.pdf)')
+    parser.add_argument('--no-cache', action='store_true', default=False,
+                        help='compile every song file instead of reusing cached results')
+    parser.add_argument('--no-format', action='store_true', default=False,
+                        help='load the full latex preamble instead of a precompiled format')
+    parser.add_argument('--per-song', action='store_true', default=False,
+                        help='compile and cache each song as its own PDF and join them (requires pypdf)')
+    parser.add_argument('--watch', action='store_true', default=False,
+                        help='rebuild the chords and/or slides whenever the song files or templates change')
+    parser.add_argument('--templates', action='append', default=[], metavar='DIR',
+                        help='use chords.tex and/or slides.tex from DIR instead of the built-in templates; may be repeated')
+    parser.add_argument('--pipe', action='store_true', default=False,
+                        help='feed the document to pdflatex while the songs are compiled')
+    parser.add_argument('--profile', action='store_true', default=False,
+                        help='print the time spent in each parser pass and build stage')
+    parser.add_argument('--profile-json', action='store', metavar='FILE',
+                        help='save the time spent in each parser pass, per song, and build stage to FILE')
+    parser.add_argument('-j', '--jobs', action='store', type=int, metavar='N',
+                        help='number of processes used to parse song files (default: all cores)')
+
+    parser.add_argument('--batch', action='store', metavar='MANIFEST',
+                        help='create the chords and/or slides of every set list in the JSON file MANIFEST')
+    parser.add_argument('--pdflatex-jobs', action='store', type=int, default=2, metavar='N',
+                        help='number of pdflatex runs at once in batch or daemon mode (default: 2)')
+
+    parser.add_argument('--daemon', action='store_true', default=False,
+                        help='run a build server on localhost that keeps songs and templates loaded between builds')
+    parser.add_argument('--port', action='store', type=int, default=client.default_port,
+                        help='port of the build server (default: {})'.format(client.default_port))
+    parser.add_argument('--server', action='store', metavar='URL',
+                        help='create chords and/or slides with the build server at URL, such as http://127.0.0.1:{}'.format(client.default_port))
+
+    parser.add_argument('--check', action='store_true', default=False,
+                        help='report all errors in the song files (default: all songs) without running latex')
+
+    parser.add_argument('--preview', action='store', choices=["html", "text"], metavar='FORMAT',
+                        help='print the song files as text or html with the chords above the lyrics, without running latex; - reads standard input')
+
+    # options for finding song files
+    parser.add_argument('--list', action='store_true', default=False,
+                        help='list the song files (default: all songs) with their titles, authors, keys and capos')
+    parser.add_argument('--search', action='store', metavar='QUERY',
+                        help='list song files whose lyrics, title or author match QUERY; quote "phrases"')
 
     # options for altering song files
-    # parser.add_argument('--transpose', action='store', type=int, metavar='N',
-    #                     help='transpose song file by number of half steps')
+    parser.add_argument('--transpose', action='store', type=int, metavar='N',
+                        help='transpose chords by number of half steps; prints the song files unless used with -c')
+    parser.add_argument('--flats', action='store_true', default=False,
+                        help='spell transposed chords with flats instead of sharps')
     return parser
 
 
@@ -71,15 +354,70 @@ if __name__ == '__main__':
     parser = getParser()
     args = parser.parse_args()
         
-    if args.chords or args.slides: # creating chords or slides
-        if args.chords:
-            chords(args.filename)
+    if args.check: # validating song files
+        sys.exit(0 if checkSongs(args.filename) else 1)
+
+    elif args.batch is not None: # creating many set lists
+        sys.exit(0 if batchBuild(args.batch) else 1)
+
+    elif args.daemon: # serving builds
+        import daemon
+        daemon.serve(args.port, jobs=args.pdflatex_jobs, workers=args.jobs, pipe=args.pipe,
+                     pdfcache=getPdfCache(args), templatedirs=args.templates)
+
+    elif args.server is not None and (args.chords or args.slides): # building with the server
+        if len(args.filename) > 0:
+            modes = [mode for mode in ("chords", "slides") if getattr(args, mode)]
+            if not checkOutputs(modes):
+                sys.exit(1)
+            try:
+                serverBuild(modes)
+            except (client.BuildError, OSError) as err:
+                print(err)
+                sys.exit(1)
+
+    elif args.chords or args.slides or args.watch: # creating chords or slides
+        if len(args.filename) > 0:
+            modes = [mode for mode in ("chords", "slides") if getattr(args, mode)]
+            if not checkOutputs(modes or ["chords", "slides"]):
+                sys.exit(1)
+            # share one PraiseTex so each song file is only parsed once
+            praisetex = createPraiseTex(args.filename)
+            try:
+                succeeded = True
+                if args.watch:
+                    watchOutputs(praisetex, modes or ["chords", "slides"])
+
+                elif args.chords and args.slides:
+                    succeeded = chordsAndSlides(praisetex)
+
+                elif args.chords:
+                    succeeded = chords(praisetex)
+
+                else:
+                    succeeded = slides(praisetex)
+                if not succeeded:
+                    sys.exit(1)
+            except core.CompileError as err: # a song file is broken
+                print(err)
+                sys.exit(1)
+            except OSError as err: # such as an output that cannot be written
+                print(err)
+                sys.exit(1)
+            finally:
+                reportProfile(praisetex)
+
+    elif args.preview is not None: # previewing songs
+        sys.exit(0 if previewSongs(args.filename, args.preview) else 1)
+
+    elif args.list: # listing songs
+        listSongs(args.filename)
 
-        if args.slides:
-            slides(args.filename)
+    elif args.search is not None: # searching songs
+        searchSongs(args.search)
 
-    # elif args.transpose is not None: # transposing song
-    #     transpose(args.filename, args.transpose)
+    elif args.transpose is not None: # transposing song
+        transposeSongs(args.filename, args.transpose)
 
     else:
         runGUI()
@@ -0,0 +1,203 @@
+"""preview.py - Previews of songs as plain text or HTML, without latex
+
+Checking where a chord falls does not need a pdflatex run. A parsed song
+is drawn with each chord above the lyrics it is sung on, in a fraction of a
+millisecond, fast enough to follow an editor as the song is typed:
+
+Verse 1
+ G      G/B        C         G
+Amazing grace! How sweet the sound
+
+Lines of chords are combined with their lyrics by
+parse.combine_chord_lines, as they are for chordsheets. Stanzas follow the
+song's order, with repeats such as 'chorus 1 x2' written out, as they are
+on slides. pdflatex is only needed for the final PDF.
+"""
+
+import html
+
+import parse
+import song as s
+
+# header commands shown above the stanzas, in the order they are shown
+header_commands = ["title", "by", "capo", "scripture", "comment"]
+
+html_style = """\
+body { font-family: sans-serif; margin: 2em; }
+.song { margin-bottom: 3em; }
+.song h1 { margin-bottom: 0.2em; }
+.song h2 { font-size: 1em; margin: 1.2em 0 0.3em; }
+.header { margin: 0.2em 0; }
+.note { margin: 0.2em 0; color: #a60; font-style: italic; }
+.line { white-space: pre; line-height: 1.2; }
+.piece { display: inline-block; }
+.chord { display: block; font-weight: bold; color: #a33; }
+.chords { font-family: monospace; font-weight: bold; color: #a33; }
+"""
+
+
+def stanza_lines(stanza):
+    """Returns the lines of a stanza, without its command
+
+    A line of chords and the lyrics below it become one song.Lyricline by
+    parse.combine_chord_lines, as on chordsheets. Lyrics without chords
+    become a Lyricline without any, and a line of chords without lyrics
+    stays a Chordline.
+    """
+    lines = []
+    for element in parse.combine_chord_lines(stanza[1:]):
+        if isinstance(element, s.Text):
+            lines.append(s.Lyricline(element.text))
+        elif not isinstance(element, s.Chordline) or len(element.chords) > 0: # skip blank lines
+            lines.append(element)
+    return lines
+
+def stanza_label(command):
+    """Returns the heading of a stanza, such as 'Verse 1'"""
+    label = command.command.capitalize()
+    if command.command_arg is not None:
+        label += " " + command.command_arg
+    return label
+
+def song_stanzas(song, expand=True):
+    """Returns the header and stanzas of a parsed song to preview
+
+    Returns (header, stanzas, notes). The header is a list of (command,
+    argument), the stanzas a list of (label, lines), see stanza_lines, and
+    notes a list of messages about the song. With expand, the stanzas
+    follow the song's order, if it has one, instead of the song file. An
+    order that is malformed or names a missing stanza, such as one that is
+    still being typed, leaves the stanzas in file order with a note.
+    """
+    header = []
+    stanzas = []
+    notes = []
+    named = {} # stanza command text -> stanza, as in handle_slides_order
+    order = None
+    for stanza in song.stanzas:
+        command = stanza[0]
+        if command.command in header_commands:
+            argument = ' '.join(element.text.strip() for element in stanza[1:])
+            header.append((command.command, argument))
+        elif command.command == 'order':
+            # slides remove chordlines before the order is used
+            order = [item.text for item in stanza[1:] if isinstance(item, s.Text)]
+        elif command.command in parse.stanza_commands:
+            named[command.text] = stanza
+            stanzas.append(stanza)
+    header.sort(key=lambda entry: header_commands.index(entry[0]))
+
+    if expand and order is not None:
+        try:
+            order = parse.expand_order(order)
+        except ValueError as err:
+            order = None
+            notes.append("{}, stanzas are in file order".format(err))
+        missing = [name for name in order or () if name not in named]
+        if len(missing) > 0:
+            notes.append("Order entry is not a stanza: {}, stanzas are in file order".format(
+                missing[0]))
+        elif order is not None:
+            stanzas = [named[name] for name in order]
+    return header, [(stanza_label(stanza[0]), stanza_lines(stanza))
+                    for stanza in stanzas], notes
+
+def chord_row(line):
+    """Returns the line of chords drawn above a Lyricline or Chordline
+
+    Each chord starts in its column, unless the chord before it reaches
+    into it.
+    """
+    if isinstance(line, s.Chordline):
+        chords = line.chords
+    else:
+        chords = zip(line.offsets, line.chords())
+    row = ""
+    for column, chord in chords:
+        if len(row) > 0 and len(row) >= column:
+            column = len(row) + 1 # keep chords apart
+        row = row.ljust(column) + chord
+    return row
+
+def header_text(command, argument):
+    """Returns how a header command is shown"""
+    if command == "by":
+        return "by " + argument
+    if command == "capo":
+        return "Capo " + argument
+    return argument
+
+
+def render_text(song, expand=True):
+    """Returns a plain text preview of a parsed song, with the chords above
+    the lyrics, for a monospaced font"""
+    header, stanzas, notes = song_stanzas(song, expand)
+    lines = [header_text(command, argument) for command, argument in header]
+    lines.extend("Note: " + note for note in notes)
+    for label, stanza in stanzas:
+        lines.append('')
+        lines.append(label)
+        for line in stanza:
+            if isinstance(line, s.Chordline) or len(line.ids) > 0:
+                lines.append(chord_row(line))
+            if isinstance(line, s.Lyricline):
+                lines.append(line.text.rstrip())
+    return '\n'.join(lines) + '\n'
+
+def lyrics_html(text):
+    """Returns the HTML of a piece of lyrics, emphasizing any text in
+    parentheses as chordsheets do"""
+    text = html.escape(text, quote=False)
+    return parse.parenthesis_regex.sub(lambda match: "<em>{}</em>".format(match.group()), text)
+
+def line_html(line):
+    """Returns the HTML of a line, each chord above its piece of the lyrics"""
+    if isinstance(line, s.Chordline):
+        return '<div class="line chords">{}</div>'.format(html.escape(chord_row(line)))
+    pieces = [lyrics_html(line.lead())]
+    for chord, text in zip(line.chords(), line.pieces()):
+        pieces.append('<span class="piece"><span class="chord">{}</span>{}</span>'.format(
+            html.escape(chord), lyrics_html(text) or ' '))
+    return '<div class="line">{}</div>'.format(''.join(pieces).rstrip())
+
+def render_html(song, expand=True):
+    """Returns an HTML preview of a parsed song, a <section> to be put in a
+    document by html_document"""
+    header, stanzas, notes = song_stanzas(song, expand)
+    parts = ['<section class="song">']
+    for command, argument in header:
+        if command == "title":
+            parts.append('<h1>{}</h1>'.format(html.escape(argument)))
+        else:
+            parts.append('<p class="header {}">{}</p>'.format(
+                command, html.escape(header_text(command, argument))))
+    for note in notes:
+        parts.append('<p class="note">{}</p>'.format(html.escape(note)))
+    for label, lines in stanzas:
+        parts.append('<div class="stanza">')
+        parts.append('<h2>{}</h2>'.format(html.escape(label)))
+        parts.extend(line_html(line) for line in lines)
+        parts.append('</div>')
+    parts.append('</section>')
+    return '\n'.join(parts) + '\n'
+
+def html_document(sections, title="praisetex preview"):
+    """Returns a whole HTML document of the songs rendered by render_html"""
+    return ('<!DOCTYPE html>\n<html>\n<head>\n<meta charset="utf-8">\n'
+            '<title>{}</title>\n<style>\n{}</style>\n</head>\n<body>\n{}</body>\n</html>\n'
+            ).format(html.escape(title), html_style, ''.join(sections))
+
+# renders a parsed song for each preview format
+renderers = {"text": render_text,
+             "html": render_html}
+
+def preview_file(filename, format="text", text=None, transposer=None, expand=True):
+    """Returns the preview of a song file in a format of renderers
+
+    text is the contents of the song, if already read, such as an editor's
+    unsaved buffer. With a transpose.Transposer the chords are transposed.
+    """
+    song = parse.parse_song(filename, text)
+    if transposer is not None:
+        song = transposer.song(song)
+    return renderers[format](song, expand)
@@ -0,0 +1,138 @@
+"""profiler.py - Where the time of a build goes
+
+Records the wall time, calls and net change in allocated memory blocks
+of every parser pass for each song, and the time of each stage of a build, such as
+reading the template or running pdflatex. Enable it for the parser with
+parse.set_profiler and for builds with PraiseTex.profiler.
+"""
+
+import contextlib
+import json
+import sys
+import threading
+import time
+
+
+class Stats(object):
+    """Totals of one pass for one song, or of one stage of a build"""
+    __slots__ = ('calls', 'seconds', 'net_blocks')
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.net_blocks = 0 # memory blocks allocated less those freed, may be negative
+
+    def add(self, other):
+        self.calls += other.calls
+        self.seconds += other.seconds
+        self.net_blocks += other.net_blocks
+
+
+class Profiler(object):
+    """Collects timings of parser passes and build stages"""
+    def __init__(self):
+        self.passes = {} # (filename, pipeline.pass) -> Stats
+        self.stages = {} # stage name -> Stats
+        self.pipelines = {} # pipeline -> the pipeline with profiled passes
+        self.lock = threading.Lock() # stages may run in several threads
+        self.local = threading.local() # song each thread is working on
+
+    def record(self, name):
+        """Returns the Stats of a pass for the current song"""
+        key = (getattr(self.local, "filename", None), name)
+        stats = self.passes.get(key)
+        if stats is None:
+            stats = self.passes.setdefault(key, Stats())
+        return stats
+
+    def wrap(self, function, name):
+        """Returns the pass function, recording each call to it"""
+        def profiled(argument):
+            stats = self.record(name)
+            blocks = sys.getallocatedblocks()
+            start = time.perf_counter()
+            result = function(argument)
+            stats.seconds += time.perf_counter() - start
+            stats.net_blocks += sys.getallocatedblocks() - blocks
+            stats.calls += 1
+            return result
+        profiled.__name__ = function.__name__
+        profiled.scope = function.scope
+        profiled.types = function.types
+        return profiled
+
+    def run(self, pipeline, stanzas, filename):
+        """Run a parse.Pipeline on a song's stanzas, recording its passes"""
+        profiled = self.pipelines.get(pipeline)
+        if profiled is None:
+            passes = [self.wrap(function, "{}.{}".format(pipeline.name, function.__name__))
+                      for function in pipeline.passes]
+            profiled = type(pipeline)(*passes, name=pipeline.name)
+            self.pipelines[pipeline] = profiled
+        self.local.filename = filename
+        try:
+            return profiled.run(stanzas)
+        finally:
+            self.local.filename = None
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Context manager recording the time spent in a stage of a build"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = time.perf_counter() - start
+            with self.lock:
+                stats = self.stages.setdefault(name, Stats())
+                stats.calls += 1
+                stats.seconds += seconds
+
+    def pass_totals(self):
+        """Returns a dict of pass name -> Stats over all songs"""
+        totals = {}
+        for (filename, name), stats in self.passes.items():
+            totals.setdefault(name, Stats()).add(stats)
+        return totals
+
+    def song_totals(self):
+        """Returns a dict of filename -> Stats of all its passes"""
+        totals = {}
+        for (filename, name), stats in self.passes.items():
+            totals.setdefault(filename, Stats()).add(stats)
+        return totals
+
+    def results(self):
+        """Returns everything recorded as a dict that can be saved as JSON"""
+        passes = [{"song": filename, "pass": name, "calls": stats.calls,
+                   "seconds": stats.seconds, "net_blocks": stats.net_blocks}
+                  for (filename, name), stats in sorted(self.passes.items(),
+                                                        key=lambda item: (str(item[0][0]), item[0][1]))]
+        stages = [{"stage": name, "calls": stats.calls, "seconds": stats.seconds}
+                  for name, stats in sorted(self.stages.items())]
+        return {"passes": passes, "stages": stages}
+
+    def save(self, filename):
+        """Write the results to a JSON file"""
+        with open(filename, "w") as f:
+            json.dump(self.results(), f, indent=1)
+
+    def table(self, songs=10):
+        """Returns the results as a table, with the slowest songs listed"""
+        lines = ["{:<50} {:>9} {:>10} {:>11}".format("pass", "calls", "seconds", "net blocks")]
+        totals = sorted(self.pass_totals().items(), key=lambda item: -item[1].seconds)
+        if len(totals) == 0:
+            lines.append("no songs were parsed, they may all have been cached")
+        for name, stats in totals:
+            lines.append("{:<50} {:>9} {:>10.4f} {:>11}".format(name, stats.calls,
+                                                               stats.seconds, stats.net_blocks))
+        lines.append("")
+        lines.append("{:<50} {:>9} {:>10}".format("stage", "calls", "seconds"))
+        for name, stats in sorted(self.stages.items(), key=lambda item: -item[1].seconds):
+            lines.append("{:<50} {:>9} {:>10.4f}".format(name, stats.calls, stats.seconds))
+        lines.append("")
+        lines.append("{:<50} {:>9} {:>10}".format("slowest songs", "calls", "seconds"))
+        slowest = sorted(self.song_totals().items(), key=lambda item: -item[1].seconds)
+        for filename, stats in slowest[:songs]:
+            lines.append("{:<50} {:>9} {:>10.4f}".format(str(filename), stats.calls,
+                                                        stats.seconds))
+        return "\n".join(lines)
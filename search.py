@@ -0,0 +1,166 @@
+"""search.py - Full-text search of lyrics, titles and authors of songs"""
+
+import bisect
+import re
+
+word_regex = re.compile(r"\w+")
+phrase_regex = re.compile(r'"([^"]*)"')
+
+
+def normalize(text):
+    """Returns text in lower case with apostrophes and punctuation removed"""
+    return ' '.join(tokenize(text))
+
+def tokenize(text):
+    """Returns the lower case words of text"""
+    return word_regex.findall(text.lower().replace("'", ""))
+
+def contains(text, phrase, prefix=False):
+    """Check if normalized text contains the words of phrase
+
+    If prefix is true, the last word of phrase may be the start of a word.
+    """
+    if prefix:
+        return (' ' + phrase) in (' ' + text)
+    return (' ' + phrase + ' ') in (' ' + text + ' ')
+
+def parse_query(query):
+    """Split a query into quoted phrases and single words
+
+    Returns (phrases, words, prefix) where prefix is the last word of the
+    query if it is unquoted, which may be incomplete while typing.
+    """
+    phrases = [normalize(phrase) for phrase in phrase_regex.findall(query)]
+    phrases = [phrase for phrase in phrases if phrase]
+    rest = phrase_regex.sub(' ', query)
+    words = tokenize(rest)
+    prefix = None
+    if words and not query.rstrip().endswith('"') and not query[-1:].isspace():
+        prefix = words.pop()
+    return phrases, words, prefix
+
+
+class SearchIndex(object):
+    """Inverted index of the words in every song of a library.SongLibrary
+
+    Maps each word to the song files containing it, and keeps each song's
+    normalized title, author and lyric lines to check phrases, along with
+    the lyric lines as written to report the matching line.
+    """
+    def __init__(self, library):
+        self.library = library
+        self.postings = {} # word -> set of filenames
+        self.documents = {} # filename -> (hash, title, by, normalized lyric lines, lyric lines)
+        self.vocabulary = [] # sorted words, for prefix matching
+        self.sorted = True # whether vocabulary is up to date
+
+    def add(self, filename, entry):
+        """Index a song file from its library entry"""
+        title = normalize(entry["title"] or filename)
+        by = normalize(entry["by"] or "")
+        lines = list(entry["lyrics"])
+        lyrics = [normalize(line) for line in lines]
+        self.documents[filename] = (entry["hash"], title, by, lyrics, lines)
+        for line in [title, by] + lyrics:
+            for word in line.split():
+                if word not in self.postings:
+                    self.postings[word] = set()
+                    self.sorted = False
+                self.postings[word].add(filename)
+
+    def remove(self, filename):
+        """Remove a song file from the index"""
+        hash, title, by, lyrics, lines = self.documents.pop(filename)
+        for line in [title, by] + lyrics:
+            for word in line.split():
+                filenames = self.postings.get(word)
+                if filenames is None:
+                    continue
+                filenames.discard(filename)
+                if not filenames:
+                    del self.postings[word]
+                    self.sorted = False
+
+    def refresh(self):
+        """Bring the index up to date with the library's entries
+
+        Only songs whose content hash changed are indexed again.
+        """
+        entries = self.library.entries
+        for filename in list(self.documents):
+            entry = entries.get(filename)
+            if entry is None or entry["hash"] != self.documents[filename][0]:
+                self.remove(filename)
+        for filename, entry in entries.items():
+            if filename not in self.documents:
+                self.add(filename, entry)
+
+    def prefixed(self, prefix):
+        """Returns the set of song files containing a word starting with prefix"""
+        if not self.sorted:
+            self.vocabulary = sorted(self.postings)
+            self.sorted = True
+        filenames = set()
+        index = bisect.bisect_left(self.vocabulary, prefix)
+        while index < len(self.vocabulary) and self.vocabulary[index].startswith(prefix):
+            filenames.update(self.postings[self.vocabulary[index]])
+            index += 1
+        return filenames
+
+    def search(self, query, limit=None):
+        """Returns a list of (filename, matching line) for a query
+
+        Every word and quoted phrase of the query must occur in the song's
+        title, author or lyrics, and the last unquoted word also matches
+        longer words starting with it. Songs matching in their title come
+        first, then songs matching by author, then by lyrics. The matching
+        line is the first lyric line containing a phrase, or the first query
+        word if there are no phrases, as written in the song file, or None
+        for title and author matches.
+        """
+        phrases, words, prefix = parse_query(query)
+        if not phrases and not words and prefix is None:
+            return []
+
+        candidates = None
+        for word in words + [word for phrase in phrases for word in phrase.split()]:
+            filenames = self.postings.get(word, set())
+            candidates = filenames if candidates is None else candidates & filenames
+        if prefix is not None:
+            filenames = self.prefixed(prefix)
+            candidates = filenames if candidates is None else candidates & filenames
+
+        # (phrase, is prefix) terms that must all be found in one field
+        terms = [(phrase, False) for phrase in phrases + words]
+        if prefix is not None:
+            terms.append((prefix, True))
+
+        results = []
+        for filename in candidates:
+            hash, title, by, lyrics, lines = self.documents[filename]
+            line = None
+            for phrase in phrases: # phrases must not span fields or lines
+                if contains(title, phrase) or contains(by, phrase):
+                    continue
+                found = [index for index, text in enumerate(lyrics) if contains(text, phrase)]
+                if not found:
+                    break
+                line = line or lines[found[0]]
+            else:
+                if all(contains(title, term, isprefix) for term, isprefix in terms):
+                    rank = 0
+                elif all(contains(by, term, isprefix) for term, isprefix in terms):
+                    rank = 1
+                else:
+                    rank = 2
+                    if line is None:
+                        term, isprefix = terms[0]
+                        line = next((lines[index] for index, text in enumerate(lyrics)
+                                     if contains(text, term, isprefix)), None)
+                results.append((rank, filename, line))
+
+        results.sort()
+        results = [(filename, line) for rank, filename, line in results]
+        if limit is not None:
+            results = results[:limit]
+        return results
@@ -2,66 +2,198 @@
 
 import os
 import re
+import threading
 
 chord_regex = re.compile("[A-G][1-9#bminajsugd]*[/]*[A-G]*[1-9#bminajsugd]*")
 valid_chords = "ABCDEFGb#minajsugd123456789"
 not_chords = "HJKLOPQRTVWXYZ\n"
 
+# matches any character that keeps a line from being a chord line: a letter
+# or digit that is not in valid_chords, or one of not_chords
+not_chord_regex = re.compile("[^\\W_{}]|[{}]".format(re.escape(valid_chords),
+                                                     re.escape(not_chords)))
 
-class Chord(object):
-    """Represents a single chord within a song file"""
-    def __init__(self, chord):
-        self.text = chord
-    def __repr__(self):
-        return "Chord({})".format(self.text)
+# kinds of line found by lex_line
+HEADER = 'header' # command starting a stanza, such as "verse 1:"
+BLANK = 'blank'
+CHORDS = 'chords'
+LYRICS = 'lyrics'
+
+# chord names are interned, each distinct name is kept once in chord_names
+# and lines refer to it by its index there, its id
+chord_names = []
+chord_index = {} # chord name -> id
+chord_lock = threading.Lock() # songs may be rendered in several threads
 
-class Chordline(object):
-    """Represents multiple chords that are on a separate line"""
-    def __init__(self, chords):
-        self.text = chords
+
+class Node(object):
+    """Base class for the immutable elements a song file is parsed into
+
+    Passes never modify a node, they build new ones, so nodes can be shared
+    between stanzas and songs.
+    """
+    __slots__ = ('text',)
+    def __init__(self, text):
+        object.__setattr__(self, 'text', text)
+    def __setattr__(self, name, value):
+        raise AttributeError("{} is immutable".format(type(self).__name__))
+    def __reduce__(self):
+        return (type(self), (self.text,))
     def __repr__(self):
-        return "Chordline({})".format(self.text)
+        return "{}({})".format(type(self).__name__, self.text)
 
-class Text(object):
+class Chord(Node):
+    """Represents a single chord within a song file"""
+    __slots__ = ()
+
+class Chordline(Node):
+    """Represents multiple chords that are on a separate line
+
+    chords holds the (column, chord) of each chord, found when the line is
+    lexed, so later stages do not search the line again.
+    """
+    __slots__ = ('chords',)
+    def __init__(self, text, chords=None):
+        Node.__init__(self, text)
+        if chords is None:
+            chords = chord_tokens(text)
+        object.__setattr__(self, 'chords', chords)
+    def __reduce__(self):
+        return (type(self), (self.text, self.chords))
+
+class Text(Node):
     """Represents plain text, such as lyrics, within a song file"""
+    __slots__ = ()
+
+class Lyricline(Node):
+    """Represents a line of lyrics with the chords placed above it
+
+    The lyrics are stored once, with the column each chord is placed at in
+    offsets and the interned id of each chord in ids, instead of as a Text
+    and a Chord for every piece of the line.
+    """
+    __slots__ = ('offsets', 'ids')
+    def __init__(self, text, offsets=(), ids=()):
+        Node.__init__(self, text)
+        object.__setattr__(self, 'offsets', offsets)
+        object.__setattr__(self, 'ids', ids)
+    def __reduce__(self):
+        # ids are only meaningful within one process, so send the names
+        return (lyricline, (self.text, self.offsets, self.chords()))
+    def chords(self):
+        """Returns the names of the chords"""
+        return tuple(chord_names[id] for id in self.ids)
+    def lead(self):
+        """Returns the lyrics before the first chord"""
+        if len(self.offsets) == 0:
+            return self.text
+        return self.text[:self.offsets[0]]
+    def pieces(self):
+        """Returns the lyrics starting at each chord, up to the next one"""
+        offsets = self.offsets
+        ends = offsets[1:] + (len(self.text),)
+        return [self.text[start:end] for start, end in zip(offsets, ends)]
+    def nodes(self):
+        """Returns the line as separate Text and Chord nodes"""
+        nodes = []
+        lead = self.lead()
+        if len(lead) > 0:
+            nodes.append(Text(lead))
+        for chord, text in zip(self.chords(), self.pieces()):
+            nodes.append(Chord(chord))
+            nodes.append(Text(text))
+        return nodes
+
+def lyricline(text, offsets, chords):
+    """Returns a Lyricline of the lyrics with the named chords"""
+    return Lyricline(text, offsets, tuple(intern_chord(chord) for chord in chords))
+
+class Command(Node):
+    """Represents a command within a song file"""
+    __slots__ = ('command', 'command_arg')
     def __init__(self, text):
-        self.text = text
+        text = text.strip()
+        textlist = text.split()
+        Node.__init__(self, text)
+        object.__setattr__(self, 'command', textlist[0].lower())
+
+        if len(textlist) == 1:
+            object.__setattr__(self, 'command_arg', None)
+        else:
+            object.__setattr__(self, 'command_arg', textlist[1])
+
+class Song(object):
+    """A parsed song file, shared by the chordsheet and slides renderers
+
+    Holds each stanza as a tuple whose first element is its Command, so
+    renderers cannot modify the song.
+    """
+    __slots__ = ('filename', 'stanzas')
+    def __init__(self, filename, stanzas):
+        self.filename = filename
+        self.stanzas = tuple(tuple(stanza) for stanza in stanzas)
+    def stanza_lists(self):
+        """Returns a new list of lists of the stanzas for a renderer to use"""
+        return [list(stanza) for stanza in self.stanzas]
     def __repr__(self):
-        return "Text({})".format(self.text)
-
-
-def combine(chord_line, lyrics):
-    """Combines a line of chords with its associated lyrics"""
+        return "Song({})".format(self.filename)
+
+
+def chord_tokens(chord_line):
+    """Returns a tuple of (column, chord) for the chords in a chord line"""
+    # columns of valid chords, paired with the words of the line
+    return tuple(zip([match.start() for match in chord_regex.finditer(chord_line)],
+                     chord_line.split()))
+
+def lex_line(line):
+    """Classify a line of a song file in a single scan
+
+    Returns (kind, chords), where kind is HEADER, BLANK, CHORDS or LYRICS,
+    and chords is the chord_tokens of a chord line or None otherwise.
+    """
+    if ':' in line:
+        return HEADER, None
+    if not_chord_regex.search(line) is not None:
+        return LYRICS, None
+    if len(line) == 0 or line.isspace():
+        return BLANK, None
+    return CHORDS, chord_tokens(line)
+
+def intern_chord(chord):
+    """Returns the id of a chord name, adding it to chord_names if new"""
+    try:
+        return chord_index[chord]
+    except KeyError:
+        pass
+    with chord_lock:
+        if chord not in chord_index:
+            chord_names.append(chord)
+            chord_index[chord] = len(chord_names) - 1
+        return chord_index[chord]
+
+def combine_line(chord_line, lyrics, chords=None):
+    """Combines a line of chords with its associated lyrics into a Lyricline
+
+    chords is the chord_tokens of the chord line, if already known.
+    """
     # make sure the lyrics line is long enough to hold chords
     if(len(chord_line) > len(lyrics)):
         lyrics = lyrics.ljust(len(chord_line))
 
-    # find valid chords
-    matches = chord_regex.finditer(chord_line)
-    # list of (location, chord)
-    chords = list(zip([match.start() for match in matches],
-                      chord_line.split()))
-    # insert chords in verse order since insertion shifts positions of subsequent chords
-    combined = []
-    chords.reverse()
-    for chord in chords:
-        loc, ch = chord
-        combined.append(Text(lyrics[loc:]))
-        combined.append(Chord(ch))
-        lyrics = lyrics[:loc]
-
-    if len(lyrics) > 0: # handle any leftover text before first chord
-        combined.append(Text(lyrics))
-
-    combined.reverse()
-    return combined
+    if chords is None:
+        chords = chord_tokens(chord_line)
+    offsets = tuple(loc for loc, chord in chords)
+    ids = tuple(intern_chord(chord) for loc, chord in chords)
+    return Lyricline(lyrics, offsets, ids)
+
+def combine(chord_line, lyrics, chords=None):
+    """Combines a line of chords with its associated lyrics, returning a
+    list of Text and Chord nodes"""
+    return combine_line(chord_line, lyrics, chords).nodes()
 
 def is_chord_line(line):
     """Checks if the line contains chords"""
-    if contains_only(line, valid_chords) and not contains_any(line, not_chords):
-        return True
-    else:
-        return False
+    return not_chord_regex.search(line) is None
 
 
 
@@ -76,26 +208,6 @@ def find_commands(text):
             
     return line_numbers
 
-def contains_any(line, letters):
-    """Check if any of the letters are in the line"""
-    for letter in letters:
-        if letter in line:
-            return True
-    return False
-
-def contains_only(line, letters):
-    """Check if the line only contains these letters"""
-    for c in line:
-        if c.isalnum(): # if character is alphanumeric
-            if c in letters:
-                continue
-            else: # character not found in letters
-                return False
-        else: # ignore non-alphanumeric characters
-            continue
-
-    return True
-
 if __name__ == '__main__':
     s = Song('songs/10000Reasons.txt')
     c = s.attributes['chorus 1']
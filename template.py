@@ -0,0 +1,142 @@
+"""template.py - The latex templates that songs are compiled into
+
+A template is split once into its preamble, the head of the document
+before the songs and the tail after them, each kept as a single string
+ready to be written. Songs go between two marker lines:
+
+% praisetex: begin songs
+  ... replaced by the songs ...
+% praisetex: end songs
+
+Templates without markers get their songs inside the innermost
+environment opened after \\begin{document}, as the original templates
+did. Loaded templates are kept until their file changes, and templates
+in user directories take the place of the built-in ones of the same name.
+"""
+
+import os
+import re
+import threading
+
+beginMarker = "% praisetex: begin songs"
+endMarker = "% praisetex: end songs"
+
+beginDocument = re.compile(r"\s*\\begin\{document\}")
+beginEnvironment = re.compile(r"\s*\\begin\{")
+endEnvironment = re.compile(r"\s*\\end\{")
+
+
+class TemplateError(Exception):
+    """Raised when a template has no place to put the songs"""
+
+
+def default_directories():
+    """Returns the user template directories, in the order they are searched
+
+    These are the directories in the PRAISETEX_TEMPLATES environment
+    variable, then 'praisetex/templates' in the user's config directory.
+    """
+    directories = [directory for directory in
+                   os.environ.get("PRAISETEX_TEMPLATES", "").split(os.pathsep)
+                   if directory]
+    base = os.environ.get("XDG_CONFIG_HOME",
+                          os.path.join(os.path.expanduser("~"), ".config"))
+    directories.append(os.path.join(base, "praisetex", "templates"))
+    return directories
+
+def find(filename, directories):
+    """Returns the template to use for a built-in template filename
+
+    The first of directories holding a file of the same name wins, falling
+    back to the built-in template itself.
+    """
+    name = os.path.basename(filename)
+    for directory in directories:
+        path = os.path.join(directory, name)
+        if os.path.isfile(path):
+            return path
+    return filename
+
+def split_points(lines):
+    """Returns the line numbers where the document begins, the songs go and
+    the template resumes after the songs"""
+    begin = None
+    for number, line in enumerate(lines):
+        if beginDocument.match(line):
+            begin = number
+            break
+    if begin is None:
+        raise TemplateError("No \\begin{document} line")
+
+    markers = [line.strip() for line in lines]
+    if beginMarker in markers or endMarker in markers:
+        if beginMarker not in markers or endMarker not in markers:
+            raise TemplateError("Both '{}' and '{}' lines are needed".format(beginMarker, endMarker))
+        insert = markers.index(beginMarker)
+        resume = markers.index(endMarker) + 1
+        if not begin < insert < resume:
+            raise TemplateError("Song markers must follow \\begin{document} in order")
+        return begin, insert, resume
+
+    # no markers, put the songs inside the innermost environment
+    insert = begin + 1
+    for number in range(begin + 1, len(lines)):
+        if endEnvironment.match(lines[number]):
+            return begin, insert, number
+        if beginEnvironment.match(lines[number]):
+            insert = number + 1
+    raise TemplateError("No \\end line to put the songs before")
+
+
+class Template(object):
+    """A latex template split around the place its songs go
+
+    preamble is everything before \\begin{document}, head the rest of the
+    document up to the songs and tail everything after them. text is the
+    whole template, for keys of cached PDFs.
+    """
+    def __init__(self, filename, lines, mtime=None, size=None):
+        self.filename = filename
+        self.mtime = mtime
+        self.size = size
+        begin, insert, resume = split_points(lines)
+        self.text = ''.join(lines)
+        self.preamble_lines = lines[:begin] # for texformat.FormatCache
+        self.preamble = ''.join(lines[:begin])
+        self.head = ''.join(lines[begin:insert])
+        self.tail = ''.join(lines[resume:])
+
+    def body(self, songtexts):
+        """Yield the document after the preamble, with the songs in place"""
+        yield self.head
+        for songtext in songtexts:
+            yield songtext
+        yield self.tail
+
+    def document(self, songtexts):
+        """Yield the whole document, with the songs in place"""
+        yield self.preamble
+        for chunk in self.body(songtexts):
+            yield chunk
+
+
+loaded = {} # filename -> Template, see load
+lock = threading.Lock() # templates may be loaded from several threads
+
+def load(filename):
+    """Returns the Template of a file, only reading it again once its
+    modification time or size has changed
+
+    Raises TemplateError if it has no place for the songs.
+    """
+    stat = os.stat(filename)
+    template = loaded.get(filename)
+    if template is not None and template.mtime == stat.st_mtime \
+       and template.size == stat.st_size:
+        return template
+    with lock:
+        with open(filename, "r") as f:
+            lines = f.readlines()
+        template = Template(filename, lines, stat.st_mtime, stat.st_size)
+        loaded[filename] = template
+    return template
@@ -0,0 +1,126 @@
+"""texformat.py - Precompiled pdflatex formats of the latex templates
+
+Dumping a template's preamble into a format file lets pdflatex skip loading
+the document class and packages on every build. Formats are named after a
+hash of the preamble and the pdflatex executable, so they are rebuilt
+automatically when either changes.
+"""
+
+import hashlib
+import os
+import shutil
+import subprocess
+import tempfile
+
+import cache
+
+
+# what pdflatex says when it cannot load a format file
+format_errors = ["can't find the format file", "Fatal format file error"]
+
+def default_directory():
+    """Returns the default directory for format files"""
+    return os.path.join(cache.default_directory(), "formats")
+
+
+class FormatCache(object):
+    """Builds and keeps pdflatex format files for template preambles"""
+    def __init__(self, directory=None, pdflatex="pdflatex"):
+        if directory is None:
+            directory = default_directory()
+        self.directory = directory
+        self.pdflatex = pdflatex
+        self.failed = set() # names of formats that could not be built
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def name(self, template, preamble):
+        """Returns the format name for a template's preamble"""
+        digest = hashlib.sha1()
+        executable = shutil.which(self.pdflatex)
+        if executable is not None: # formats only work with the same pdflatex
+            stat = os.stat(executable)
+            digest.update("{}\0{}\0".format(executable, stat.st_mtime).encode("utf-8"))
+        digest.update(''.join(preamble).encode("utf-8"))
+        base = os.path.splitext(os.path.basename(template))[0]
+        return "{}-{}".format(base, digest.hexdigest()[:16])
+
+    def build(self, name, preamble):
+        """Dump the preamble into a format file, returning True on success"""
+        # build under a temporary job name and rename it into place, so
+        # concurrent builds never see a partially written format
+        fd, source = tempfile.mkstemp(dir=self.directory, prefix=name, suffix=".tex")
+        jobname = os.path.splitext(os.path.basename(source))[0]
+        with os.fdopen(fd, "w") as f:
+            f.writelines(preamble)
+            f.write("\\dump\n")
+
+        built = False
+        try:
+            with open(os.devnull, "w") as devnull:
+                error = subprocess.call([self.pdflatex, "-ini", "-halt-on-error",
+                                         "-jobname=" + jobname, "&pdflatex",
+                                         os.path.basename(source)],
+                                        cwd=self.directory, stdout=devnull)
+            fmt = os.path.join(self.directory, jobname + ".fmt")
+            if not error and os.path.isfile(fmt):
+                os.replace(fmt, os.path.join(self.directory, name + ".fmt"))
+                built = True
+        finally:
+            # remove temporary files
+            for fname in os.listdir(self.directory):
+                if fname.startswith(jobname):
+                    os.remove(os.path.join(self.directory, fname))
+
+        return built
+
+    def get(self, template, preamble):
+        """Returns the format name for a template's preamble lines, building
+        it if needed
+
+        Returns None if the format cannot be built, in which case the full
+        template should be compiled instead.
+        """
+        name = self.name(template, preamble)
+        if name in self.failed: # do not retry a failed build every time
+            return None
+        if os.path.isfile(os.path.join(self.directory, name + ".fmt")):
+            return name
+        try:
+            if self.build(name, preamble):
+                return name
+        except OSError: # pdflatex is not installed
+            pass
+        self.failed.add(name)
+        return None
+
+    def command(self, name, texfile):
+        """Returns the pdflatex command line compiling texfile with a format"""
+        return [self.pdflatex, "-fmt=" + name, "-halt-on-error",
+                "\\pdfminorversion=4", "\\input{" + texfile + "}"]
+
+    def load_failed(self, log):
+        """Returns True if the pdflatex run with the log file could not load
+        its format, as pdflatex stops before writing a log in that case"""
+        try:
+            with open(log, "r", errors="replace") as f:
+                text = f.read()
+        except (IOError, OSError):
+            return True
+        return any(error in text for error in format_errors)
+
+    def discard(self, name):
+        """Stop using a format that cannot be loaded, so it is built again
+        by the next process instead of being retried by this one"""
+        self.failed.add(name)
+        try:
+            os.remove(os.path.join(self.directory, name + ".fmt"))
+        except OSError: # already removed
+            pass
+
+    def environment(self):
+        """Returns the environment letting pdflatex find the format files"""
+        env = os.environ.copy()
+        # trailing separator keeps the default search path
+        env["TEXFORMATS"] = self.directory + os.pathsep + env.get("TEXFORMATS", "")
+        return env
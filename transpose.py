@@ -0,0 +1,123 @@
+"""transpose.py - Transposing the chords of songs into another key
+
+The transposed name of every root note is looked up in tables built once
+for all 12 keys and both sharp and flat spellings, and each chord is only
+transposed the first time it is seen, so a whole set of songs can be
+transposed together.
+"""
+
+import re
+
+import song as s
+
+# half steps above A of every spelling of a root note
+semitones = {"A": 0, "A#": 1, "Bb": 1, "B": 2, "Cb": 2, "B#": 3, "C": 3,
+             "C#": 4, "Db": 4, "D": 5, "D#": 6, "Eb": 6, "E": 7, "Fb": 7,
+             "E#": 8, "F": 8, "F#": 9, "Gb": 9, "G": 10, "G#": 11, "Ab": 11}
+sharp_names = ["A", "A#", "B", "C", "C#", "D", "D#", "E", "F", "F#", "G", "G#"]
+flat_names = ["A", "Bb", "B", "C", "Db", "D", "Eb", "E", "F", "Gb", "G", "Ab"]
+
+# chords within a line of chords
+chord_token_regex = re.compile(r"\S+")
+
+
+def build_table(halfsteps, names):
+    """Returns a dict mapping each root note to the one halfsteps above it"""
+    return dict((root, names[(semitone + halfsteps) % 12])
+                for root, semitone in semitones.items())
+
+# tables[preferSharps][halfsteps] maps a root note to its transposed name
+tables = {True: [build_table(n, sharp_names) for n in range(12)],
+          False: [build_table(n, flat_names) for n in range(12)]}
+
+def split_root(chord):
+    """Split a chord into its root note and the rest, e.g. F#m7 -> F#, m7"""
+    if chord[1:2] in ("#", "b"):
+        return chord[:2], chord[2:]
+    return chord[:1], chord[1:]
+
+
+class Transposer(object):
+    """Transposes chords, lines of chords and songs by a number of half steps"""
+    def __init__(self, halfsteps, preferSharps=True):
+        self.halfsteps = int(halfsteps) % 12
+        self.preferSharps = preferSharps
+        self.table = tables[preferSharps][self.halfsteps]
+        self.chords = {} # chord -> transposed chord, filled as chords are seen
+        self.ids = {} # chord id -> transposed chord id, see song.intern_chord
+
+    def __getstate__(self):
+        # chord ids are only meaningful within one process, see
+        # song.Lyricline.__reduce__, so a process pool starts without them
+        state = self.__dict__.copy()
+        state["ids"] = {}
+        return state
+
+    def name(self):
+        """Returns a short name of the transposition, such as +3#"""
+        return "{:+d}{}".format(self.halfsteps, "#" if self.preferSharps else "b")
+
+    def chord(self, chord):
+        """Returns the transposed chord, including the bass note of slash chords"""
+        try:
+            return self.chords[chord]
+        except KeyError:
+            pass
+        notes = []
+        for note in chord.split('/'):
+            root, rest = split_root(note)
+            # leave anything that is not a note, such as N.C., alone
+            notes.append(self.table.get(root, root) + rest)
+        transposed = '/'.join(notes)
+        self.chords[chord] = transposed
+        return transposed
+
+    def chord_id(self, id):
+        """Returns the id of the transposed chord of an interned chord id"""
+        try:
+            return self.ids[id]
+        except KeyError:
+            pass
+        transposed = s.intern_chord(self.chord(s.chord_names[id]))
+        self.ids[id] = transposed
+        return transposed
+
+    def line(self, line):
+        """Returns the transposed line of chords
+
+        Each chord stays in the column it started in, so it still lines up
+        with its lyrics, unless the chord before it has grown into it.
+        """
+        transposed = ""
+        for match in chord_token_regex.finditer(line):
+            start = match.start()
+            if len(transposed) > 0 and len(transposed) >= start:
+                start = len(transposed) + 1 # keep chords apart
+            transposed = transposed.ljust(start) + self.chord(match.group())
+        return transposed + line[len(line.rstrip()):] # keep line ending
+
+    def element(self, element):
+        """Returns the transposed song element"""
+        if isinstance(element, s.Chordline):
+            return s.Chordline(self.line(element.text))
+        if isinstance(element, s.Chord):
+            return s.Chord(self.chord(element.text))
+        if isinstance(element, s.Lyricline): # chords keep their columns
+            return s.Lyricline(element.text, element.offsets,
+                               tuple(self.chord_id(id) for id in element.ids))
+        return element
+
+    def song(self, song):
+        """Returns a new song.Song with every chord transposed"""
+        element = self.element
+        return s.Song(song.filename,
+                      [[element(e) for e in stanza] for stanza in song.stanzas])
+
+    def text(self, text):
+        """Returns the text of a song file with every line of chords transposed"""
+        lines = text.splitlines(True)
+        for num, line in enumerate(lines):
+            kind, chords = s.lex_line(line.rstrip("\r\n"))
+            if kind == s.CHORDS:
+                lines[num] = self.line(line)
+        return ''.join(lines)
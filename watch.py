@@ -0,0 +1,156 @@
+"""watch.py - Waiting for song files and templates to change
+
+Uses inotify through the C library on Linux, and falls back to comparing
+modification times every so often everywhere else.
+"""
+
+import ctypes
+import os
+import select
+import struct
+import time
+
+# inotify flags, from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_NONBLOCK = 0x00000800
+IN_CLOEXEC = 0x00080000
+
+# header of each event read from inotify: wd, mask, cookie, length of name
+event_header = struct.Struct("iIII")
+
+
+class Watcher(object):
+    """Base class of watchers, which report changes to a set of files"""
+    debounce = 0.3 # seconds without changes before reporting them
+
+    def __init__(self, paths):
+        # changes are reported with the paths as they were given
+        self.paths = dict((os.path.normpath(path), path) for path in paths)
+
+    def changes(self, timeout):
+        """Returns the set of paths changed within timeout seconds, or
+        forever if timeout is None"""
+        raise NotImplementedError
+
+    def wait(self):
+        """Block until files change and return them once they have settled
+
+        Editors often write a file in several steps, so changes are only
+        reported once no more have been seen for debounce seconds.
+        """
+        changed = set()
+        while len(changed) == 0:
+            changed = self.changes(None)
+        while True:
+            more = self.changes(self.debounce)
+            if len(more) == 0:
+                return changed
+            changed |= more
+
+    def close(self):
+        """Stop watching"""
+        pass
+
+
+class PollingWatcher(Watcher):
+    """Watches files by comparing their modification times and sizes"""
+    def __init__(self, paths, interval=0.5):
+        Watcher.__init__(self, paths)
+        self.interval = interval
+        self.stats = dict((path, self.stat(path)) for path in self.paths)
+
+    def stat(self, path):
+        """Returns what is compared to notice a change, None if missing"""
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return (stat.st_mtime, stat.st_size)
+
+    def scan(self):
+        """Returns the set of paths changed since the last scan"""
+        changed = set()
+        for path, old in self.stats.items():
+            new = self.stat(path)
+            if new != old:
+                self.stats[path] = new
+                changed.add(self.paths[path])
+        return changed
+
+    def changes(self, timeout):
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            changed = self.scan()
+            if len(changed) > 0:
+                return changed
+            if deadline is None:
+                time.sleep(self.interval)
+            elif time.time() >= deadline:
+                return changed
+            else:
+                time.sleep(min(self.interval, deadline - time.time()))
+
+
+class InotifyWatcher(Watcher):
+    """Watches files with Linux's inotify, so changes are seen at once
+
+    The directories holding the files are watched rather than the files,
+    since many editors save by writing a new file and renaming it.
+    Raises OSError or AttributeError where inotify is not available.
+    """
+    mask = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE
+
+    def __init__(self, paths):
+        Watcher.__init__(self, paths)
+        libc = ctypes.CDLL(None, use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self.directories = {} # watch descriptor -> directory
+        try:
+            for directory in set(os.path.dirname(path) for path in self.paths):
+                wd = libc.inotify_add_watch(self.fd, os.fsencode(directory or "."),
+                                            self.mask)
+                if wd < 0:
+                    raise OSError(ctypes.get_errno(),
+                                  "cannot watch directory {}".format(directory))
+                self.directories[wd] = directory
+        except OSError:
+            os.close(self.fd)
+            raise
+
+    def changes(self, timeout):
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if len(ready) == 0:
+            return set()
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return set()
+
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, cookie, length = event_header.unpack_from(data, offset)
+            offset += event_header.size
+            name = os.fsdecode(data[offset:offset+length].rstrip(b"\0"))
+            offset += length
+            path = os.path.normpath(os.path.join(self.directories.get(wd, ""), name))
+            if path in self.paths:
+                changed.add(self.paths[path])
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watcher(paths):
+    """Returns the best watcher available for the paths"""
+    try:
+        return InotifyWatcher(paths)
+    except (OSError, AttributeError): # not Linux, or out of watches
+        return PollingWatcher(paths)